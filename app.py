@@ -7,16 +7,32 @@ import zipfile
 import re
 import datetime
 # 延迟导入，直到函数需要时才加载，避免启动时因依赖问题崩溃
-# import pandas as pd
 # import pypandoc
 # import weasyprint
 import pathlib
+import urllib.parse
+import urllib.request
 import base64
+import codecs
 import mimetypes
 import json
 import traceback
-from flask import Flask, request, jsonify, render_template_string, send_from_directory, Response
-from pypdf import PdfReader
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+import collections
+import csv
+import contextlib
+import sqlite3
+import time
+import signal
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+try: import resource  # 仅Unix可用，用于限制工作进程的内存
+except ImportError: resource = None
+from flask import Flask, request, jsonify, render_template_string, send_from_directory, Response, stream_with_context
+from pypdf import PdfReader, PdfWriter
 from werkzeug.utils import secure_filename
 
 # ==============================================================================
@@ -26,8 +42,117 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_DIR = os.path.join(BASE_DIR, 'output')
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-TASKS = {}
-TASKS_LOCK = threading.Lock()
+# 任务状态存储: sqlite（默认，保存在output/tasks.db，重启后仍可查询/下载，可供多个进程共享）或 memory（仅当前进程内存）
+TASK_STORE_BACKEND = os.environ.get('TASK_STORE', 'sqlite').lower()
+TASK_DB_PATH = os.environ.get('TASK_DB_PATH', os.path.join(OUTPUT_DIR, 'tasks.db'))
+
+# 输出目录清理: 各状态任务的保留时间(小时，0为永久保留)、任务目录总容量上限(MB，0为不限制)，超出时按最后更新时间从旧到新淘汰
+TASK_TTL_HOURS = {
+    'READY': float(os.environ.get('TASK_TTL_READY_HOURS', '24')),
+    'SUCCESS': float(os.environ.get('TASK_TTL_SUCCESS_HOURS', '72')),
+    'FAILURE': float(os.environ.get('TASK_TTL_FAILURE_HOURS', '72')),
+}
+# 上传处理中、排队中和转换中的任务，不会被清理，也不能再次开始转换；超过 TASK_STALE_HOURS 小时未更新的
+# （如解压过程中服务崩溃，或关闭了RESUME_ON_START时重启前未完成的任务）标记为失败，之后按失败任务的保留时间清理
+ACTIVE_TASK_STATES = ('PREPARING', 'EXTRACTING', 'QUEUED', 'PROGRESS')
+TASK_STALE_HOURS = float(os.environ.get('TASK_STALE_HOURS', '24'))
+OUTPUT_QUOTA_BYTES = int(float(os.environ.get('OUTPUT_QUOTA_MB', '0')) * 1024 * 1024)
+JANITOR_INTERVAL_SECONDS = max(10, int(os.environ.get('JANITOR_INTERVAL_SECONDS', '300')))
+# 转换成功后删除上传的ZIP和解压出的源文件，保留结果压缩包和result目录中的PDF（之后无法再预览或重新转换）
+DELETE_SOURCE_AFTER_CONVERSION = os.environ.get('DELETE_SOURCE_AFTER_CONVERSION', '1') != '0'
+JANITOR_THREAD = None
+JANITOR_LOCK = threading.Lock()
+JANITOR_STATS = {'runs': 0, 'last_run': None, 'output_bytes': 0, 'tasks_expired': 0, 'tasks_over_quota': 0,
+                 'tasks_stale': 0, 'orphans_removed': 0, 'sources_released': 0, 'bytes_reclaimed': 0}
+
+# 汇总报告: 每完成一个文件写入一行CSV；REPORT_JSONL=1 时另外生成包含耗时、PDF大小和缓存命中情况的JSON Lines明细
+REPORT_CSV_NAME = "转换结果汇总.csv"
+REPORT_JSONL_NAME = "转换结果明细.jsonl"
+REPORT_COLUMNS = ["大目录", "文件名", "页数", "编码", "状态"]
+REPORT_JSONL = os.environ.get('REPORT_JSONL', '0') == '1'
+# 非UTF-8的Markdown文件按开头多少字节猜测编码（GB18030、Big5、Shift-JIS）
+ENCODING_SAMPLE_BYTES = max(1024, int(os.environ.get('ENCODING_SAMPLE_BYTES', str(64 * 1024))))
+
+# 断点续转: 任务目录中的检查点记录转换设置和每个已完成文件的结果，续转时只重新转换失败、缺失或源文件已变化的文件。
+# 服务启动时及之后每轮后台清理时恢复所在进程已退出的排队中或转换中的任务。排队中和转换中的任务由所在进程定期刷新更新时间，
+# 超过 TASK_LEASE_SECONDS 秒未刷新的才视为中断，并通过比较并设置状态认领，多个Web进程共享任务数据库时每个任务只会被一个进程恢复
+CHECKPOINT_NAME = 'checkpoint.jsonl'
+RESUME_ON_START = os.environ.get('RESUME_ON_START', '1') != '0'
+TASK_LEASE_SECONDS = max(10, int(os.environ.get('TASK_LEASE_SECONDS', '60')))
+RECOVERY_STARTED = False
+RECOVERY_LOCK = threading.Lock()
+
+# 进度推送: 长轮询和SSE连接单次最长等待秒数
+STATUS_WAIT_MAX_SECONDS = 30
+TERMINAL_STATES = ('SUCCESS', 'FAILURE')
+
+# 并行转换: 工作进程数大于1时，任务内的文件会分发到进程池中并行转换（WeasyPrint排版为CPU密集型，线程无法并行）
+CONVERSION_WORKERS = max(1, int(os.environ.get('CONVERSION_WORKERS', '1')))
+PROCESS_POOL = None
+PROCESS_POOL_LOCK = threading.Lock()
+
+# 渲染隔离: Web服务中的Markdown排版（转换和预览）都在独立的工作进程中进行，不占用Flask进程的内存。
+# 单个文件超过 RENDER_TIMEOUT_SECONDS 秒或工作进程超出内存上限(MB，0为不限制)时，只记录该文件失败，任务继续转换其余文件
+RENDER_TIMEOUT_SECONDS = max(1, int(os.environ.get('RENDER_TIMEOUT_SECONDS', '120')))
+RENDER_MEMORY_LIMIT_BYTES = int(float(os.environ.get('RENDER_MEMORY_LIMIT_MB', '2048')) * 1024 * 1024)
+# 工作进程卡在C代码中（如pango/cairo排版）时SIGALRM无法中断，父进程在任务开始执行后超过限时再加上这段宽限仍未得到结果时终止进程池
+RENDER_DEADLINE_GRACE_SECONDS = 30
+PREVIEW_WORKERS = max(1, int(os.environ.get('PREVIEW_WORKERS', '1')))
+PREVIEW_POOL = None
+
+# 任务内调度: 按估算的开销从大到小分发文件（大文件最先开始，不会在最后成为拖慢整个任务的文件），进度和剩余时间按已完成的开销计算。
+# 开销以页为单位估算: 每个文件固定1页，Markdown文本按 PREVIEW_CHARS_PER_PAGE 字节折算页数，引用的本地图片和Word文档每 COST_BYTES_PER_PAGE 字节折算一页
+COST_BYTES_PER_PAGE = 512 * 1024
+
+# 上传解压在后台线程中进行，/prepare_upload 只负责接收文件
+INGEST_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ingest')
+
+# 任务调度: 同时运行的转换任务数（工作线程预算）和排队上限，超出上限的请求会被拒绝
+MAX_CONCURRENT_JOBS = max(1, int(os.environ.get('MAX_CONCURRENT_JOBS', '2')))
+MAX_QUEUED_JOBS = max(1, int(os.environ.get('MAX_QUEUED_JOBS', '20')))
+
+# 渲染缓存: 以Markdown内容、引用图片、CSS和代码主题的哈希为键缓存PDF，命中时还要核对排版时读取过的本地文件，超出容量(MB，0为禁用)后按最近使用时间淘汰
+CACHE_DIR = os.path.join(OUTPUT_DIR, '_cache')
+RENDER_CACHE_DIR = os.path.join(CACHE_DIR, 'render')
+RENDER_CACHE_MAX_BYTES = int(float(os.environ.get('RENDER_CACHE_MAX_MB', '2048')) * 1024 * 1024)
+RENDER_CACHE_VERSION = '2'  # 渲染流程变化导致旧缓存失效时递增
+CACHE_ENTRY_MIN_BYTES = 4096  # 计算缓存容量时每个文件至少按一个磁盘块计
+
+# 图片处理方式: base64 把本地图片内联进Markdown；file 保留图片路径，由WeasyPrint从源目录直接加载，单文档内存占用接近纯文本大小
+IMAGE_EMBED_MODE = os.environ.get('IMAGE_EMBED_MODE', 'base64')
+
+# 图片优化: 按页面可打印宽度和目标DPI缩小过大的图片并重新压缩（0为禁用），结果按图片内容哈希缓存在磁盘上，
+# 超出容量(MB，0为不限制)后按最近使用时间淘汰
+IMAGE_TARGET_DPI = max(0, int(os.environ.get('IMAGE_TARGET_DPI', '0')))
+IMAGE_CACHE_DIR = os.path.join(CACHE_DIR, 'images')
+IMAGE_CACHE_MAX_BYTES = int(float(os.environ.get('IMAGE_CACHE_MAX_MB', '1024')) * 1024 * 1024)
+OPTIMIZED_IMAGES = {}  # (路径, 修改时间, 大小, 目标宽度) -> 优化后的路径，避免同一进程内重复计算哈希
+
+# Word转换: 同时运行的xelatex作业数和单个文件的超时时间(秒)；xelatex的字体/格式缓存保存在共享目录中
+WORD_WORKERS = max(1, int(os.environ.get('WORD_WORKERS', str(min(4, os.cpu_count() or 1)))))
+WORD_TIMEOUT_SECONDS = max(1, int(os.environ.get('WORD_TIMEOUT_SECONDS', '300')))
+TEX_CACHE_DIR = os.path.join(CACHE_DIR, 'tex')
+WORD_EXECUTOR = None
+
+# Pandoc批量转换: 每批最多多少个Markdown文件在同一个Pandoc进程中转换为HTML（1为逐个调用）
+PANDOC_BATCH_SIZE = max(1, int(os.environ.get('PANDOC_BATCH_SIZE', '32')))
+
+# 预览缓存: 内存中缓存内联图片后的Markdown、Pandoc输出的HTML和预览PDF，总容量(MB)超出后按LRU淘汰
+PREVIEW_CACHE_MAX_BYTES = int(float(os.environ.get('PREVIEW_CACHE_MAX_MB', '256')) * 1024 * 1024)
+
+# WeasyPrint样式表和字体配置在每个进程内复用: 字体发现(fontconfig)只进行一次，相同样式的CSS只解析一次
+FONT_CONFIG = None
+STYLESHEETS = collections.OrderedDict()  # CSS文本 -> weasyprint.CSS
+STYLESHEET_CACHE_SIZE = 32
+STYLESHEET_LOCK = threading.Lock()
+
+# 启动预热: 在后台导入转换依赖并渲染一个小文档（转换和预览进程池的每个工作进程各一次），完成前 /ready 返回503
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', '1') != '0'
+WARMUP_STATE = {'state': 'PENDING', 'started_at': None, 'finished_at': None, 'seconds': None, 'pool_workers': 0, 'preview_workers': 0, 'error': None}
+WARMUP_LOCK = threading.Lock()
+
+# 快速预览: 只排版HTML的前缀部分，按估算的每页字符数截取，页数不足时加倍重试
+PREVIEW_CHARS_PER_PAGE = 3000
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 设置上传文件大小限制为100MB
@@ -228,7 +353,11 @@ HTML_TEMPLATE = """
                                         <div class="col-md-4 d-flex flex-column"><label for="link_color" class="form-label" data-i18n-key="style_link_color">链接颜色</label><input type="color" id="link_color" class="form-control form-control-color" value="#0d6efd"></div>
                                     </div>
                                 </fieldset>
-                                <div class="d-grid gap-2 mt-4">
+                                <div class="form-check mt-4">
+                                    <input class="form-check-input" type="checkbox" id="fastPreviewCheck" checked>
+                                    <label class="form-check-label" for="fastPreviewCheck" data-i18n-key="fast_preview">快速预览（仅渲染前 5 页）</label>
+                                </div>
+                                <div class="d-grid gap-2 mt-3">
                                     <button type="button" id="previewBtn" class="btn btn-secondary" data-i18n-key="preview_btn" disabled><i class="bi bi-eye-fill me-2"></i>应用样式并预览</button>
                                 </div>
                             </div>
@@ -248,10 +377,17 @@ HTML_TEMPLATE = """
                                 </div>
                             </div>
                         </div>
+                        <div id="full-preview-area" class="d-grid mt-2" style="display: none;">
+                            <button type="button" id="fullPreviewBtn" class="btn btn-outline-secondary btn-sm" data-i18n-key="full_preview_btn"><i class="bi bi-file-earmark-pdf me-2"></i>加载完整预览</button>
+                        </div>
                     </div>
                 </div>
 
-                <div class="d-grid mt-5">
+                <div class="form-check d-flex justify-content-center gap-2 mt-5">
+                    <input class="form-check-input" type="checkbox" id="mergePdfCheck">
+                    <label class="form-check-label" for="mergePdfCheck" data-i18n-key="merge_pdf">同时生成合并后的单个PDF（按目录和文件添加书签）</label>
+                </div>
+                <div class="d-grid mt-3">
                     <button type="button" id="convertBtn" class="btn btn-convert text-white fw-bold" data-i18n-key="convert_btn" disabled><i class="bi bi-lightning-charge-fill me-2"></i>开始转换</button>
                 </div>
 
@@ -266,6 +402,9 @@ HTML_TEMPLATE = """
                     <div id="download-area" class="d-grid mt-4" style="display: none;">
                         <a id="download-link" href="#" class="btn btn-success btn-lg" data-i18n-key="download_btn"><i class="bi bi-cloud-download me-2"></i>下载结果</a>
                     </div>
+                    <div id="resume-area" class="d-grid mt-2" style="display: none;">
+                        <button type="button" id="resumeBtn" class="btn btn-outline-warning" data-i18n-key="resume_btn"><i class="bi bi-arrow-repeat me-2"></i>续转: 只重新转换失败的文件</button>
+                    </div>
                 </div>
             </div>
         </div>
@@ -274,6 +413,7 @@ HTML_TEMPLATE = """
     document.addEventListener('DOMContentLoaded', function() {
         let currentTaskId = null;
         let currentLang = 'zh';
+        let uploadSeq = 0;
 
         const i18n = {
              zh: {
@@ -281,6 +421,7 @@ HTML_TEMPLATE = """
                 step1_title: "1. 选择转换模式", step2_title: "2. 上传文件", step3_title: "3. 自定义样式",
                 upload_zip: "上传ZIP压缩包", upload_folder: "上传整个文件夹",
                 status_initial: "选择文件后将开始准备预览。", status_preparing: "文件上传和预处理中...",
+                status_extracting: "正在解压文件... {progress}%",
                 status_ready: "✅ 准备就绪！共找到 {count} 个可预览文件。", status_no_md: "⚠️ 上传成功，但未找到可预览的.md文件。",
                 status_word_ready: "✅ 上传成功，可以开始转换。", status_error: "❌ 错误: {error}",
                 select_preview_file: "选择预览文件:",
@@ -293,10 +434,15 @@ HTML_TEMPLATE = """
                 style_text_color: "正文颜色", style_heading_color: "标题颜色",
                 style_link_color: "链接颜色",
                 preview_btn: "应用样式并预览", preview_btn_generating: "生成中...",
+                merge_pdf: "同时生成合并后的单个PDF（按目录和文件添加书签）",
+                fast_preview: "快速预览（仅渲染前 5 页）", full_preview_btn: "仅显示了前几页，加载完整预览",
                 preview_title: "实时预览",
                 convert_btn: "开始转换", convert_btn_converting: "转换中...",
+                queue_position: "排队中（第 {position} 位）", eta_remaining: "预计剩余 {eta}",
                 progress_title: "转换进度", log_title: "实时日志",
-                download_btn: "下载结果",
+                download_btn: "下载结果", resume_btn: "续转: 只重新转换失败的文件",
+                sources_released: "源文件已清理，无法再预览或重新转换；如需修改样式请重新上传。",
+                task_missing: "任务不存在或已被清理，请重新上传。",
                 alert_no_preview_file: "没有可供预览的文件。",
                 alert_preview_error: "预览错误: {error}",
                 alert_conversion_start_error: "开始转换失败: {error}"
@@ -306,6 +452,7 @@ HTML_TEMPLATE = """
                 step1_title: "1. Select Mode", step2_title: "2. Upload File", step3_title: "3. Customize Style",
                 upload_zip: "Upload ZIP", upload_folder: "Upload Folder",
                 status_initial: "Select a file to prepare for preview.", status_preparing: "Uploading and processing files...",
+                status_extracting: "Extracting files... {progress}%",
                 status_ready: "✅ Ready! Found {count} previewable files.", status_no_md: "⚠️ Uploaded, but no previewable .md files found.",
                 status_word_ready: "✅ Upload complete. Ready to convert.", status_error: "❌ Error: {error}",
                 select_preview_file: "Select file to preview:",
@@ -318,10 +465,15 @@ HTML_TEMPLATE = """
                 style_text_color: "Text Color", style_heading_color: "Heading Color",
                 style_link_color: "Link Color",
                 preview_btn: "Apply Style & Preview", preview_btn_generating: "Generating...",
+                merge_pdf: "Also produce one merged PDF (bookmarked by folder and file)",
+                fast_preview: "Quick preview (first 5 pages only)", full_preview_btn: "Showing first pages only, load full preview",
                 preview_title: "Live Preview",
                 convert_btn: "Start Conversion", convert_btn_converting: "Converting...",
+                queue_position: "Queued (position {position})", eta_remaining: "about {eta} left",
                 progress_title: "Conversion Progress", log_title: "Live Log",
-                download_btn: "Download Result",
+                download_btn: "Download Result", resume_btn: "Resume: re-convert failed files only",
+                sources_released: "The source files have been cleaned up and can no longer be previewed or converted; upload again to change the style.",
+                task_missing: "The task no longer exists or has been cleaned up; please upload again.",
                 alert_no_preview_file: "No file available for preview.",
                 alert_preview_error: "Preview Error: {error}",
                 alert_conversion_start_error: "Failed to start conversion: {error}"
@@ -339,8 +491,11 @@ HTML_TEMPLATE = """
             progressArea: document.getElementById('progress-area'), progressBar: document.getElementById('progress-bar'),
             logContainer: document.getElementById('log-container'), downloadArea: document.getElementById('download-area'),
             downloadLink: document.getElementById('download-link'),
+            resumeArea: document.getElementById('resume-area'), resumeBtn: document.getElementById('resumeBtn'),
             langZhBtn: document.getElementById('lang-zh'), langEnBtn: document.getElementById('lang-en'),
-            previewOverlay: document.getElementById('preview-overlay')
+            previewOverlay: document.getElementById('preview-overlay'),
+            fastPreviewCheck: document.getElementById('fastPreviewCheck'), mergePdfCheck: document.getElementById('mergePdfCheck'),
+            fullPreviewArea: document.getElementById('full-preview-area'), fullPreviewBtn: document.getElementById('fullPreviewBtn')
         };
 
         function updateLanguage(lang) {
@@ -378,9 +533,11 @@ HTML_TEMPLATE = """
         ui.zipRadio.addEventListener('change', toggleUploadMode);
         ui.folderRadio.addEventListener('change', toggleUploadMode);
         ui.fileInput.addEventListener('change', handleFileSelection);
-        ui.previewBtn.addEventListener('click', generatePreview);
+        ui.previewBtn.addEventListener('click', () => generatePreview());
+        ui.fullPreviewBtn.addEventListener('click', () => generatePreview(true));
         ui.convertBtn.addEventListener('click', startConversion);
-        ui.previewFileSelect.addEventListener('change', generatePreview);
+        ui.resumeBtn.addEventListener('click', resumeConversion);
+        ui.previewFileSelect.addEventListener('change', () => generatePreview());
 
         function getStyleOptions() {
             const elements = document.querySelectorAll('#style-options-fieldset select, #style-options-fieldset input');
@@ -414,6 +571,7 @@ HTML_TEMPLATE = """
             ui.statusMessage.className = 'alert alert-info';
             ui.previewContainer.src = 'about:blank';
             ui.previewFileSelectorArea.style.display = 'none';
+            ui.fullPreviewArea.style.display = 'none';
             ui.progressArea.style.display = 'none';
         }
 
@@ -437,10 +595,13 @@ HTML_TEMPLATE = """
             ui.convertBtn.disabled = true;
             ui.previewFileSelectorArea.style.display = 'none';
 
+            const seq = ++uploadSeq;
             try {
                 const response = await fetch('/prepare_upload', { method: 'POST', body: formData });
-                const data = await response.json();
+                let data = await response.json();
                 if (!response.ok) throw new Error(data.error || 'Server failed to prepare files');
+                if (data.state === 'EXTRACTING') data = await waitForExtraction(data.task_id, seq);
+                if (!data || seq !== uploadSeq) return;  // 等待期间用户又选择了其他文件
 
                 currentTaskId = data.task_id;
                 ui.convertBtn.disabled = false;
@@ -472,7 +633,21 @@ HTML_TEMPLATE = """
             }
         }
         
-        async function generatePreview() {
+        const FAST_PREVIEW_PAGES = 5;
+
+        async function waitForExtraction(taskId, seq) {
+            let cursor = 0, version = -1;
+            while (seq === uploadSeq) {
+                const statusData = await fetchStatus(taskId, cursor, version);
+                cursor = statusData.cursor; version = statusData.version;
+                if (statusData.state === 'READY') return { task_id: taskId, preview_files: statusData.preview_files || [] };
+                if (statusData.state !== 'EXTRACTING') throw new Error(statusData.error || 'Extraction failed');
+                ui.statusMessage.textContent = i18n[currentLang].status_extracting.replace('{progress}', statusData.progress);
+            }
+            return null;
+        }
+
+        async function generatePreview(fullRender = false) {
             if (!currentTaskId || !ui.previewFileSelect.value) {
                 alert(i18n[currentLang].alert_no_preview_file);
                 return;
@@ -480,6 +655,7 @@ HTML_TEMPLATE = """
 
             ui.previewOverlay.style.display = 'flex';
             ui.previewBtn.disabled = true;
+            ui.fullPreviewArea.style.display = 'none';
 
             try {
                 const payload = {
@@ -487,6 +663,7 @@ HTML_TEMPLATE = """
                     style_options: getStyleOptions(),
                     preview_file: ui.previewFileSelect.value
                 };
+                if (!fullRender && ui.fastPreviewCheck.checked) payload.preview_pages = FAST_PREVIEW_PAGES;
 
                 const response = await fetch('/preview', {
                     method: 'POST',
@@ -499,6 +676,7 @@ HTML_TEMPLATE = """
                     throw new Error(errorText || 'Preview generation failed');
                 }
                 
+                ui.fullPreviewArea.style.display = response.headers.get('X-Preview-Truncated') === '1' ? 'grid' : 'none';
                 const blob = await response.blob();
                 const pdfUrl = URL.createObjectURL(blob);
 
@@ -519,8 +697,18 @@ HTML_TEMPLATE = """
         }
 
         function startConversion() {
+            runConversion('/start_conversion', { task_id: currentTaskId, style_options: ui.mdMode.checked ? getStyleOptions() : {}, merge_pdf: ui.mergePdfCheck.checked });
+        }
+
+        // 续转沿用上次的样式和合并设置，由服务端从检查点读取
+        function resumeConversion() {
+            runConversion('/resume_conversion', { task_id: currentTaskId });
+        }
+
+        function runConversion(url, body) {
             if (!currentTaskId) return;
             ui.convertBtn.disabled = true;
+            ui.resumeArea.style.display = 'none';
             ui.convertBtn.innerHTML = `<span class="spinner-border spinner-border-sm"></span> ${i18n[currentLang].convert_btn_converting}`;
             ui.progressArea.style.display = 'block';
             ui.logContainer.innerHTML = '';
@@ -529,16 +717,16 @@ HTML_TEMPLATE = """
             ui.progressBar.textContent = '0%';
             ui.progressBar.classList.remove('bg-danger', 'bg-success');
             
-            fetch('/start_conversion', {
+            fetch(url, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ task_id: currentTaskId, style_options: ui.mdMode.checked ? getStyleOptions() : {} })
+                body: JSON.stringify(body)
             })
             .then(res => res.json())
             .then(data => {
                 if (data.error) throw new Error(data.error);
                 appendLog({ log: `转换任务已开始, ID: ${data.task_id}`, is_diag: false });
-                pollStatus(data.task_id);
+                watchStatus(data.task_id, data.cursor || 0);
             })
             .catch(error => {
                 alert(i18n[currentLang].alert_conversion_start_error.replace('{error}', error.message));
@@ -547,30 +735,77 @@ HTML_TEMPLATE = """
             });
         }
         
-        function pollStatus(taskId) {
-            const interval = setInterval(() => {
-                fetch(`/status/${taskId}`)
-                .then(res => res.json())
+        function handleStatus(statusData) {
+            // 任务记录已被清理，停止推送和轮询
+            if (statusData.state === 'UNKNOWN') {
+                ui.progressBar.classList.add('bg-danger');
+                ui.convertBtn.disabled = true;
+                ui.previewBtn.disabled = true;
+                appendLog({ log: i18n[currentLang].task_missing, is_diag: false });
+                return true;
+            }
+            ui.progressBar.style.width = statusData.progress + '%';
+            ui.progressBar.textContent = statusData.progress + '%';
+            if (statusData.state === 'QUEUED' && statusData.queue_position) {
+                ui.progressBar.textContent = i18n[currentLang].queue_position.replace('{position}', statusData.queue_position);
+            }
+            if (statusData.state === 'PROGRESS' && statusData.eta_seconds != null) {
+                ui.progressBar.textContent += ' · ' + i18n[currentLang].eta_remaining.replace('{eta}', formatEta(statusData.eta_seconds));
+            }
+            if (statusData.logs && statusData.logs.length > 0) {
+                 statusData.logs.forEach(logEntry => appendLog(logEntry));
+            }
+            if (statusData.state === 'SUCCESS' || statusData.state === 'FAILURE') {
+                ui.convertBtn.disabled = false;
+                ui.convertBtn.innerHTML = `<i class="bi bi-lightning-charge-fill me-2"></i> ${i18n[currentLang].convert_btn}`;
+                if (statusData.state === 'SUCCESS') {
+                    ui.progressBar.classList.add('bg-success');
+                    ui.downloadLink.href = statusData.result_url;
+                    ui.downloadArea.style.display = 'block';
+                } else {
+                    ui.progressBar.classList.add('bg-danger');
+                }
+                const hasFailedFiles = statusData.failed_files && statusData.failed_files.length > 0;
+                ui.resumeArea.style.display = statusData.state === 'FAILURE' || hasFailedFiles ? 'block' : 'none';
+                // 源文件已清理时预览和重新转换都只会返回410
+                if (statusData.source_released) {
+                    ui.convertBtn.disabled = true;
+                    ui.previewBtn.disabled = true;
+                    ui.statusMessage.textContent = i18n[currentLang].sources_released;
+                    ui.statusMessage.className = 'alert alert-secondary';
+                }
+                return true;
+            }
+            return false;
+        }
+
+        function formatEta(seconds) {
+            if (seconds < 60) return currentLang === 'zh' ? `${seconds} 秒` : `${seconds}s`;
+            const minutes = Math.round(seconds / 60);
+            return currentLang === 'zh' ? `${minutes} 分钟` : `${minutes} min`;
+        }
+
+        // 优先使用SSE接收推送；浏览器不支持时退回到按游标的长轮询
+        // cursor 为本次转换开始时的日志位置，之前的上传日志和上一次转换的日志不再重放
+        function watchStatus(taskId, cursor) {
+            if (window.EventSource) {
+                const source = new EventSource(`/events/${taskId}?cursor=${cursor}`);
+                source.onmessage = event => { if (handleStatus(JSON.parse(event.data))) source.close(); };
+                return;
+            }
+            let version = -1;
+            const poll = () => fetchStatus(taskId, cursor, version)
                 .then(statusData => {
-                    ui.progressBar.style.width = statusData.progress + '%';
-                    ui.progressBar.textContent = statusData.progress + '%';
-                    if (statusData.logs && statusData.logs.length > 0) {
-                         statusData.logs.forEach(logEntry => appendLog(logEntry));
-                    }
-                    if (statusData.state === 'SUCCESS' || statusData.state === 'FAILURE') {
-                        clearInterval(interval);
-                        ui.convertBtn.disabled = false;
-                        ui.convertBtn.innerHTML = `<i class="bi bi-lightning-charge-fill me-2"></i> ${i18n[currentLang].convert_btn}`;
-                        if (statusData.state === 'SUCCESS') {
-                            ui.progressBar.classList.add('bg-success');
-                            ui.downloadLink.href = statusData.result_url;
-                            ui.downloadArea.style.display = 'block';
-                        } else {
-                            ui.progressBar.classList.add('bg-danger');
-                        }
-                    }
-                });
-            }, 1500);
+                    cursor = statusData.cursor; version = statusData.version;
+                    if (!handleStatus(statusData)) poll();
+                })
+                .catch(() => setTimeout(poll, 2000));
+            poll();
+        }
+
+        async function fetchStatus(taskId, cursor, version) {
+            const response = await fetch(`/status/${taskId}?cursor=${cursor}&version=${version}&wait=25`);
+            return response.json();
         }
 
         function appendLog(logEntry) {
@@ -611,78 +846,802 @@ def handle_global_exception(e):
 def favicon():
     return '', 204
 
-def read_file_with_fallback(file_path):
+# 文件开头的BOM及对应编码，UTF-32的BOM以UTF-16的BOM开头，需要先判断
+TEXT_BOMS = [(codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+             (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+
+def _common_gb18030(b): return len(b) == 2 and (0xB0 <= b[0] <= 0xD7 or b[0] in (0xA1, 0xA3)) and b[1] >= 0xA1
+def _common_big5(b): return len(b) == 2 and (0xA4 <= b[0] <= 0xC6 or b[0] == 0xA1)
+def _common_shift_jis(b): return len(b) == 2 and (0x81 <= b[0] <= 0x83 or 0x88 <= b[0] <= 0x98)
+
+# 非UTF-8文件的候选编码，及判断一个字符是否落在该编码常用字区（GB2312一级汉字、Big5常用字、JIS假名和第一水准汉字）的函数。
+# 同一段字节按错误的编码解码时大多落在生僻字区或无法解码，因此取常用字比例最高的编码，相同时按列表顺序优先
+LEGACY_ENCODINGS = [('gb18030', _common_gb18030), ('big5', _common_big5), ('shift_jis', _common_shift_jis)]
+
+def detect_legacy_encoding(data):
+    """根据文件开头 ENCODING_SAMPLE_BYTES 字节猜测非UTF-8文件的编码，都无法解码时返回None"""
+    sample, best, best_score = data[:ENCODING_SAMPLE_BYTES], None, -1.0
+    for encoding, is_common in LEGACY_ENCODINGS:
+        # 样本末尾可能截断在多字节字符中间，不按错误处理
+        try: text = codecs.getincrementaldecoder(encoding)().decode(sample, final=len(sample) == len(data))
+        except UnicodeDecodeError: continue
+        wide = [c for c in text if ord(c) > 0x7F]
+        score = sum(1 for c in wide if is_common(c.encode(encoding))) / len(wide) if wide else 0.0
+        if score > best_score: best, best_score = encoding, score
+    return best
+
+def decode_text(data):
+    """把文件内容解码为文本，返回 (文本, 编码)。依次判断BOM、UTF-8和常见中日文编码，
+    无法完整解码的字节替换为U+FFFD并在编码名后注明，不会静默丢弃"""
+    for bom, encoding in TEXT_BOMS:
+        if data.startswith(bom): return data.decode(encoding, errors='replace'), encoding
+    try: return data.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError: pass
+    encoding = detect_legacy_encoding(data) or 'gb18030'
+    try: return data.decode(encoding), encoding
+    except UnicodeDecodeError: return data.decode(encoding, errors='replace'), encoding + '（含无法解码的字节）'
+
+def read_markdown_file(file_path):
+    """只读取一次文件，返回 (原始字节, 文本, 检测到的编码)，原始字节同时用于计算渲染缓存键"""
     try:
-        with open(file_path, 'r', encoding='utf-8-sig') as f:
-            return f.read()
-    except UnicodeDecodeError:
-        print(f"      [LOG] 文件 {os.path.basename(file_path)} 不是UTF-8编码，尝试使用GBK编码...")
-        with open(file_path, 'r', encoding='gbk', errors='ignore') as f:
-            return f.read()
+        with open(file_path, 'rb') as f: data = f.read()
     except Exception as e:
         print(f"      [ERROR] 读取文件 {os.path.basename(file_path)} 时发生未知错误: {e}")
         raise
+    text, encoding = decode_text(data)
+    if encoding != 'utf-8' and encoding != 'utf-8-sig':
+        print(f"      [LOG] 文件 {os.path.basename(file_path)} 不是UTF-8编码，按 {encoding} 读取。")
+    return data, text, encoding
+
+# ==============================================================================
+# 耗时统计和监控指标
+# ==============================================================================
+class StageTimer:
+    """按阶段累计耗时（秒）和次数，用法: with timer.stage('pandoc'): ..."""
+    def __init__(self):
+        self.seconds, self.counts = collections.defaultdict(float), collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try: yield
+        finally: self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, count=1):
+        self.seconds[name] += seconds
+        self.counts[name] += count
+
+    def merge(self, stages):
+        for name, seconds in stages.items(): self.add(name, seconds)
+
+    def total(self): return sum(self.seconds.values())
+
+    def rounded(self): return {name: round(seconds, 4) for name, seconds in self.seconds.items()}
+
+    def summary(self): return {name: {'seconds': round(seconds, 3), 'count': self.counts[name]} for name, seconds in self.seconds.items()}
+
+
+class Metrics:
+    """进程内的计数器和直方图，/metrics 以Prometheus文本格式导出（多个Web进程时每个进程各自导出）"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    HELP = {
+        'md2pdf_stage_seconds': ('histogram', '各处理阶段的耗时（文件级阶段每个文件一次，上传/解压/扫描/合并每个任务一次）'),
+        'md2pdf_files_total': ('counter', '已转换的文件数'),
+        'md2pdf_file_failures_total': ('counter', '转换失败的文件数'),
+        'md2pdf_pages_total': ('counter', '已生成的PDF页数'),
+        'md2pdf_output_bytes_total': ('counter', '已生成的PDF字节数'),
+        'md2pdf_tasks_total': ('counter', '结束的转换任务数'),
+        'md2pdf_janitor_reclaimed_bytes_total': ('counter', '后台清理释放的磁盘字节数'),
+        'md2pdf_queue_depth': ('gauge', '排队等待转换槽位的任务数'),
+        'md2pdf_running_jobs': ('gauge', '正在转换的任务数'),
+        'md2pdf_conversion_workers_configured': ('gauge', '配置的转换工作进程数（CONVERSION_WORKERS）'),
+        'md2pdf_preview_cache_bytes': ('gauge', '预览缓存占用的内存字节数'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)  # (名称, 标签) -> 值
+        self.histograms = {}  # (名称, 标签) -> [各桶累计计数, 总和, 次数]
+
+    def inc(self, name, value=1, **labels):
+        with self.lock: self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for j, bound in enumerate(self.BUCKETS):
+                if value <= bound: hist[0][j] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def observe_stages(self, timer):
+        for name, seconds in timer.seconds.items(): self.observe('md2pdf_stage_seconds', seconds, stage=name)
+
+    @staticmethod
+    def _labels(labels):
+        if not labels: return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+    def render(self, gauges):
+        """gauges: [(名称, {标签}, 值)]，在导出时由调用方计算"""
+        samples = collections.defaultdict(list)
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()): samples[name].append(f"{name}{self._labels(labels)} {value:g}")
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                for bound, bucket_count in zip(self.BUCKETS, buckets):
+                    samples[name].append(f"{name}_bucket{self._labels(labels + (('le', f'{bound:g}'),))} {bucket_count}")
+                samples[name].append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {count}")
+                samples[name].append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+                samples[name].append(f"{name}_count{self._labels(labels)} {count}")
+        for name, labels, value in gauges: samples[name].append(f"{name}{self._labels(tuple(sorted(labels.items())))} {value:g}")
+        lines = []
+        for name in sorted(samples):
+            metric_type, help_text = self.HELP.get(name, ('untyped', name))
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"] + samples[name]
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
 
-def update_task_status(task_id, state, progress=None, log=None, error=None, result_url=None, is_diag=False, preview_files=None):
-    with TASKS_LOCK:
-        if task_id not in TASKS: TASKS[task_id] = {}
-        task = TASKS[task_id]
-        task['state'] = state
-        if progress is not None: task['progress'] = progress
-        if log: task.setdefault('logs', []).append({'log': log, 'is_diag': is_diag})
-        if error: task.setdefault('logs', []).append({'log': f"❌ 任务失败: {error}", 'is_diag': False}); task['error'] = error
-        if result_url: task['result_url'] = result_url
-        if preview_files is not None: task['preview_files'] = preview_files
-
-def get_and_clear_logs(task_id):
-    with TASKS_LOCK:
-        logs = TASKS.get(task_id, {}).get('logs', [])
-        if logs: TASKS[task_id]['logs'] = []
-        return logs
+# ==============================================================================
+# 任务状态存储
+# ==============================================================================
+class MemoryTaskStore:
+    """任务状态保存在当前进程的内存中，重启后丢失，只适用于单个Web进程"""
+    def __init__(self):
+        self.tasks = {}
+        self.conditions = {}
+        self.lock = threading.Lock()  # 只保护 tasks / conditions 的增删，任务内容的读写使用各任务自己的条件变量
+
+    def _condition(self, task_id):
+        cond = self.conditions.get(task_id)
+        if cond is None:
+            with self.lock: cond = self.conditions.setdefault(task_id, threading.Condition())
+        return cond
+
+    def create(self, task_id, fields):
+        cond = self._condition(task_id)
+        with cond:
+            with self.lock: self.tasks[task_id] = dict(fields, logs=[], version=0, updated_at=time.time())
+            cond.notify_all()
+
+    def update(self, task_id, fields, logs=()):
+        cond = self._condition(task_id)
+        with cond:
+            task = self.tasks.get(task_id)
+            if task is None:
+                with self.lock: task = self.tasks.setdefault(task_id, {'logs': [], 'version': 0})
+            task.update(fields)
+            task['logs'].extend(logs)
+            # 每次更新递增版本号并唤醒等待中的长轮询/SSE连接
+            task['version'] += 1
+            task['updated_at'] = time.time()
+            cond.notify_all()
+
+    def modify(self, task_id, func, logs=()):
+        """原子地读取并修改任务: func(任务记录或None) 返回要更新的字段，返回None时不修改。返回是否已修改"""
+        cond = self._condition(task_id)
+        with cond:
+            task = self.tasks.get(task_id)
+            fields = func({k: v for k, v in task.items() if k != 'logs'} if task else None)
+            if fields is None: return False
+            self.update(task_id, fields, logs)  # 条件变量可重入，仍在同一次加锁内
+            return True
+
+    def get(self, task_id):
+        if task_id not in self.tasks: return None
+        with self._condition(task_id):
+            task = self.tasks.get(task_id)
+            return {k: v for k, v in task.items() if k != 'logs'} if task else None
+
+    def get_logs(self, task_id, cursor=0):
+        if task_id not in self.tasks: return [], 0
+        with self._condition(task_id):
+            logs = self.tasks.get(task_id, {}).get('logs', [])
+            cursor = min(max(cursor, 0), len(logs))
+            return logs[cursor:], len(logs)
+
+    def wait(self, task_id, version, timeout):
+        if task_id not in self.tasks: return
+        cond = self._condition(task_id)
+        with cond:
+            cond.wait_for(lambda: task_id not in self.tasks or self.tasks[task_id]['version'] != version, timeout=timeout)
+
+    def delete(self, task_id):
+        with self.lock:
+            self.tasks.pop(task_id, None)
+            cond = self.conditions.pop(task_id, None)
+        if cond is not None:
+            with cond: cond.notify_all()  # 唤醒等待中的长轮询/SSE连接，使其发现任务已不存在
+
+    def task_ids(self):
+        with self.lock: return list(self.tasks)
+
+    def touch(self, task_ids):
+        """只刷新更新时间（不递增版本号，不唤醒等待者），用于续租排队中和转换中的任务"""
+        now = time.time()
+        for task_id in task_ids:
+            task = self.tasks.get(task_id)
+            if task: task['updated_at'] = now
+
+
+class SQLiteTaskStore:
+    """任务状态保存在SQLite数据库中，重启后仍可查询和下载，多个Web进程和工作进程可以共享同一个数据库文件
+
+    频繁更新的字段单独成列，其余字段(预览文件列表等)以JSON保存在data列中；日志逐条追加到task_logs表。
+    每次更新都是一个短的写事务，读取不加锁(WAL模式下读写互不阻塞)。同一进程内的等待者由条件变量立即唤醒，
+    其他进程写入的更新由每个进程一个的监视线程通过 PRAGMA data_version 发现后唤醒，空闲的等待者不查询数据库。
+    """
+    COLUMNS = ('state', 'progress', 'error', 'result_url')
+    POLL_INTERVAL = 0.5
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY, state TEXT, progress INTEGER, error TEXT, result_url TEXT,
+            data TEXT NOT NULL DEFAULT '{}', version INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS task_logs (
+            task_id TEXT NOT NULL, seq INTEGER NOT NULL, log TEXT NOT NULL, is_diag INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (task_id, seq));
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()  # sqlite3连接不能跨线程共享，每个线程使用自己的连接
+        self.conditions = {}
+        self.watchers = collections.Counter()  # task_id -> 正在等待该任务更新的连接数
+        self.watch_thread = None
+        self.lock = threading.Lock()
+        self.initialized = False
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if not self.initialized:
+                with self.lock:
+                    conn.execute('PRAGMA journal_mode=WAL')
+                    conn.executescript(self.SCHEMA)
+                    self.initialized = True
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _condition(self, task_id):
+        cond = self.conditions.get(task_id)
+        if cond is None:
+            with self.lock: cond = self.conditions.setdefault(task_id, threading.Condition())
+        return cond
+
+    def _notify(self, task_id):
+        cond = self.conditions.get(task_id)
+        if cond is not None:
+            with cond: cond.notify_all()
+
+    def create(self, task_id, fields):
+        columns = {k: fields.get(k) for k in self.COLUMNS}
+        data = {k: v for k, v in fields.items() if k not in self.COLUMNS}
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM task_logs WHERE task_id = ?', (task_id,))
+            conn.execute('INSERT OR REPLACE INTO tasks (task_id, state, progress, error, result_url, data, version, updated_at) VALUES (?, ?, ?, ?, ?, ?, 0, ?)',
+                         (task_id, *columns.values(), json.dumps(data, ensure_ascii=False), time.time()))
+        self._notify(task_id)
+
+    def update(self, task_id, fields, logs=()):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            self._apply(conn, task_id, row[0] if row else None, fields, logs)
+        self._notify(task_id)
+
+    def modify(self, task_id, func, logs=()):
+        """在同一个写事务中读取并修改任务（多个进程之间也是原子的）: func(任务记录或None) 返回要更新的字段，
+        返回None时不修改。返回是否已修改"""
+        with self._transaction() as conn:
+            row = conn.execute('SELECT state, progress, error, result_url, data, version, updated_at FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            fields = func(self._row_to_task(row) if row else None)
+            if fields is None: return False
+            self._apply(conn, task_id, row[4] if row else None, fields, logs)
+        self._notify(task_id)
+        return True
+
+    def _apply(self, conn, task_id, data_json, fields, logs):
+        columns = {k: v for k, v in fields.items() if k in self.COLUMNS}
+        extra = {k: v for k, v in fields.items() if k not in self.COLUMNS}
+        if data_json is None:
+            conn.execute("INSERT INTO tasks (task_id, updated_at) VALUES (?, ?)", (task_id, time.time()))
+        sets = [f"{k} = ?" for k in columns] + ['version = version + 1', 'updated_at = ?']
+        params = list(columns.values()) + [time.time()]
+        if extra:
+            # 只有非列字段变化时才解析和重写JSON，进度更新只改几个列
+            data = json.loads(data_json) if data_json else {}
+            data.update(extra)
+            sets.append('data = ?'); params.append(json.dumps(data, ensure_ascii=False))
+        conn.execute(f"UPDATE tasks SET {', '.join(sets)} WHERE task_id = ?", params + [task_id])
+        if logs:
+            start = conn.execute('SELECT COALESCE(MAX(seq), -1) + 1 FROM task_logs WHERE task_id = ?', (task_id,)).fetchone()[0]
+            conn.executemany('INSERT INTO task_logs (task_id, seq, log, is_diag) VALUES (?, ?, ?, ?)',
+                             [(task_id, start + i, entry['log'], int(entry['is_diag'])) for i, entry in enumerate(logs)])
+
+    def _row_to_task(self, row):
+        task = json.loads(row[4])
+        task.update({k: v for k, v in zip(self.COLUMNS, row[:4]) if v is not None})
+        task['version'], task['updated_at'] = row[5], row[6]
+        return task
+
+    def get(self, task_id):
+        row = self._conn().execute('SELECT state, progress, error, result_url, data, version, updated_at FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return self._row_to_task(row) if row else None
+
+    def get_logs(self, task_id, cursor=0):
+        cursor = max(cursor, 0)
+        rows = self._conn().execute('SELECT log, is_diag FROM task_logs WHERE task_id = ? AND seq >= ? ORDER BY seq', (task_id, cursor)).fetchall()
+        if not rows:
+            total = self._conn().execute('SELECT COALESCE(MAX(seq), -1) + 1 FROM task_logs WHERE task_id = ?', (task_id,)).fetchone()[0]
+            return [], min(cursor, total)
+        return [{'log': log, 'is_diag': bool(is_diag)} for log, is_diag in rows], cursor + len(rows)
+
+    def _version(self, task_id):
+        row = self._conn().execute('SELECT version FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return row[0] if row else None
+
+    def wait(self, task_id, version, timeout):
+        """等待本进程内的更新通知；其他进程写入的更新由 _watch_loop 发现后同样通过条件变量唤醒，等待期间不查询数据库"""
+        cond = self._condition(task_id)
+        with self.lock:
+            self.watchers[task_id] += 1
+            if self.watch_thread is None:
+                self.watch_thread = threading.Thread(target=self._watch_loop, name='task-store-watch', daemon=True)
+                self.watch_thread.start()
+        try:
+            with cond: cond.wait_for(lambda: self._version(task_id) != version, timeout=timeout)
+        finally:
+            with self.lock:
+                self.watchers[task_id] -= 1
+                if self.watchers[task_id] <= 0: del self.watchers[task_id]
+
+    def _watch_loop(self):
+        # 每个进程只有一个线程轮询: 有等待者时每 POLL_INTERVAL 秒读取一次 PRAGMA data_version（只有其他连接提交了写事务时才会变化），
+        # 变化时唤醒所有等待者各自检查版本号；没有等待者时不访问数据库
+        data_version = None
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+            with self.lock: task_ids = list(self.watchers)
+            if not task_ids:
+                data_version = None
+                continue
+            try: current = self._conn().execute('PRAGMA data_version').fetchone()[0]
+            except sqlite3.Error: continue
+            if data_version is not None and current != data_version:
+                for task_id in task_ids: self._notify(task_id)
+            data_version = current
+
+    def delete(self, task_id):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM task_logs WHERE task_id = ?', (task_id,))
+            conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+        self._notify(task_id)
+        with self.lock: self.conditions.pop(task_id, None)
+
+    def task_ids(self):
+        return [row[0] for row in self._conn().execute('SELECT task_id FROM tasks')]
+
+    def touch(self, task_ids):
+        """只刷新更新时间（不递增版本号，不唤醒等待者），用于续租排队中和转换中的任务"""
+        if not task_ids: return
+        with self._transaction() as conn:
+            conn.executemany('UPDATE tasks SET updated_at = ? WHERE task_id = ?', [(time.time(), task_id) for task_id in task_ids])
+
+
+def create_task_store():
+    if TASK_STORE_BACKEND == 'memory': return MemoryTaskStore()
+    if TASK_STORE_BACKEND != 'sqlite': raise ValueError(f"未知的TASK_STORE: {TASK_STORE_BACKEND}（可选 sqlite / memory）")
+    return SQLiteTaskStore(TASK_DB_PATH)
+
+TASK_STORE = create_task_store()
+
+def update_task_status(task_id, state, progress=None, log=None, error=None, result_url=None, is_diag=False, preview_files=None, eta_seconds=None):
+    fields, logs = {'state': state}, []
+    if progress is not None: fields['progress'] = progress
+    # 剩余时间只在转换过程中有意义，进入其他状态时清除
+    if eta_seconds is not None or state != 'PROGRESS': fields['eta_seconds'] = eta_seconds
+    if log: logs.append({'log': log, 'is_diag': is_diag})
+    if error: logs.append({'log': f"❌ 任务失败: {error}", 'is_diag': False}); fields['error'] = error
+    if result_url: fields['result_url'] = result_url
+    if preview_files is not None: fields['preview_files'] = preview_files
+    TASK_STORE.update(task_id, fields, logs)
+
+def add_task_timings(task_id, stage_summary):
+    """把各阶段的累计耗时 {阶段: {'seconds', 'count'}} 加到任务记录的 timings 字段，/status 中返回。
+    读取和写回在同一个存储事务中完成，并发的更新不会互相覆盖"""
+    def merge(task):
+        timings = (task or {}).get('timings') or {}
+        for name, item in stage_summary.items():
+            total = timings.setdefault(name, {'seconds': 0, 'count': 0})
+            total['seconds'] = round(total['seconds'] + item['seconds'], 3)
+            total['count'] += item['count']
+        return {'timings': timings}
+    TASK_STORE.modify(task_id, merge)
+
+def get_task_snapshot(task_id, cursor=0):
+    """返回任务当前状态和从cursor开始的新日志；日志不会被清除，多个查看者各自维护自己的游标"""
+    task = TASK_STORE.get(task_id) or {}
+    logs, cursor = TASK_STORE.get_logs(task_id, cursor)
+    snapshot = {'state': task.get('state', 'UNKNOWN'), 'progress': task.get('progress', 0), 'logs': logs, 'cursor': cursor,
+                'version': task.get('version', 0), 'error': task.get('error'), 'result_url': task.get('result_url'), 'preview_files': task.get('preview_files'),
+                'timings': task.get('timings'), 'failed_files': task.get('failed_files'), 'eta_seconds': task.get('eta_seconds'),
+                'source_released': bool(task.get('source_released'))}
+    snapshot['queue_position'] = JOB_SCHEDULER.queue_position(task_id) if snapshot['state'] == 'QUEUED' else None
+    return snapshot
+
+def current_log_cursor(task_id):
+    """任务当前的日志条数；新开始的一次转换从这里查看日志，不会重放上传和上一次转换的日志"""
+    return TASK_STORE.get_logs(task_id, sys.maxsize)[1]
+
+def wait_for_task_update(task_id, version, timeout):
+    """阻塞直到任务的版本号不再等于version或超时"""
+    TASK_STORE.wait(task_id, version, timeout)
 
 def get_pdf_page_count(pdf_file_path):
     try:
         with open(pdf_file_path, 'rb') as f: return len(PdfReader(f).pages)
     except Exception: return '无法读取'
 
-def preprocess_markdown_images(md_content, md_file_dir):
+def wrap_html_body(html_body):
+    return f'<!DOCTYPE html><html><head><meta charset="UTF-8"></head><body><article class="markdown-body">{html_body}</article></body></html>'
+
+MARKDOWN_IMAGE_RE = re.compile(r'!\[(.*?)\]\((.*?)\)')
+
+def is_path_within(path, root_dir):
+    path, root_dir = os.path.realpath(path), os.path.realpath(root_dir)
+    return path == root_dir or path.startswith(root_dir + os.sep)
+
+def resolve_local_image(link, md_file_dir, root_dir=None):
+    """把Markdown中的图片链接解析为存在的本地文件路径，远程图片、不存在的文件或root_dir之外的文件返回None"""
+    if link.startswith(('http://', 'https://', 'data:image')): return None
+    clean_link = link.split('?')[0].split('#')[0]
+    absolute_image_path = os.path.normpath(os.path.join(md_file_dir, clean_link))
+    if root_dir and not is_path_within(absolute_image_path, root_dir):
+        print(f"      [ERROR] 图片路径超出源目录，已忽略: {link}")
+        return None
+    return absolute_image_path if os.path.isfile(absolute_image_path) else None
+
+def image_max_width_px(style_options):
+    """根据A4纸宽度和页边距计算图片在目标DPI下的最大像素宽度，未启用图片优化时返回None"""
+    if IMAGE_TARGET_DPI <= 0: return None
+    units_in_cm = {'cm': 1.0, 'mm': 0.1, 'in': 2.54, 'pt': 2.54 / 72, 'px': 2.54 / 96}
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?|\.\d+)\s*(cm|mm|in|pt|px)?\s*', str(style_options.get('page_margin', '2.54cm')))
+    margin_cm = float(match.group(1)) * units_in_cm[match.group(2) or 'cm'] if match else 2.54
+    printable_width_cm = max(21.0 - 2 * margin_cm, 1.0)
+    return int(printable_width_cm / 2.54 * IMAGE_TARGET_DPI + 0.5)
+
+def touch_cache_entry(path):
+    """更新缓存文件的修改时间（作为LRU淘汰依据），文件不存在（或已被淘汰）时返回False"""
+    try: os.utime(path)
+    except OSError: return False
+    return True
+
+def optimize_image(image_path, max_width):
+    """把宽度超过max_width的图片缩小并重新压缩，返回优化后的图片路径；无需优化或处理失败时返回原路径"""
+    stat = os.stat(image_path)
+    memo_key = (image_path, stat.st_mtime_ns, stat.st_size, max_width)
+    result = OPTIMIZED_IMAGES.get(memo_key)
+    # 缓存的优化结果已被淘汰时重新生成
+    if result == image_path or (result and touch_cache_entry(result)): return result
+
+    h = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''): h.update(chunk)
+    digest = h.hexdigest()
+    entry_base = os.path.join(IMAGE_CACHE_DIR, digest[:2], f"{digest}-{max_width}")
+    result = image_path
+    if touch_cache_entry(entry_base + '.keep'):
+        pass  # 之前已确认该图片无需优化
+    elif touch_cache_entry(entry_base + '.png'): result = entry_base + '.png'
+    elif touch_cache_entry(entry_base + '.jpg'): result = entry_base + '.jpg'
+    else:
+        try:
+            from PIL import Image, ImageOps
+            with Image.open(image_path) as img:
+                # 缩放和重新编码会丢掉EXIF方向标记，先按标记旋转，宽度也按旋转后的计算
+                source_format = img.format
+                img = ImageOps.exif_transpose(img)
+                resized = img.width > max_width
+                if resized:
+                    img = img.resize((max_width, max(1, round(img.height * max_width / img.width))), Image.LANCZOS)
+                # JPEG照片保持JPEG有损压缩，截图等其他格式统一输出为无损PNG
+                if source_format == 'JPEG':
+                    ext, save_kwargs = '.jpg', {'format': 'JPEG', 'quality': 85, 'optimize': True, 'progressive': True}
+                    if img.mode not in ('RGB', 'L'): img = img.convert('RGB')
+                else:
+                    ext, save_kwargs = '.png', {'format': 'PNG', 'optimize': True}
+                    if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'): img = img.convert('RGBA')
+                os.makedirs(os.path.dirname(entry_base), exist_ok=True)
+                tmp_path = f"{entry_base}.{os.getpid()}.{threading.get_ident()}.tmp"
+                img.save(tmp_path, **save_kwargs)
+            if resized or os.path.getsize(tmp_path) < stat.st_size:
+                os.replace(tmp_path, entry_base + ext)
+                result = entry_base + ext
+                print(f"      [LOG] 图片已优化: {os.path.basename(image_path)} ({stat.st_size} -> {os.path.getsize(result)} 字节)")
+            else:
+                os.remove(tmp_path)
+                open(entry_base + '.keep', 'w').close()
+        except Exception as e:
+            print(f"      [ERROR] 优化图片 {os.path.basename(image_path)} 失败，使用原图: {e}")
+
+    if len(OPTIMIZED_IMAGES) > 10000: OPTIMIZED_IMAGES.clear()
+    OPTIMIZED_IMAGES[memo_key] = result
+    return result
+
+def preprocess_markdown_images(md_content, md_file_dir, root_dir=None, max_image_width=None):
+    # file 模式下保留图片路径，由 make_weasyprint_html 设置的 base_url 和受限的 url_fetcher 加载
+    if IMAGE_EMBED_MODE == 'file' and not max_image_width: return md_content
     def replacer(match):
         alt_text, link = match.group(1), match.group(2)
-        if link.startswith(('http://', 'https://', 'data:image')): return match.group(0)
-        clean_link = link.split('?')[0].split('#')[0]
-        absolute_image_path = os.path.normpath(os.path.join(md_file_dir, clean_link))
-        if os.path.exists(absolute_image_path):
+        absolute_image_path = resolve_local_image(link, md_file_dir, root_dir)
+        if absolute_image_path:
+            if max_image_width: absolute_image_path = optimize_image(absolute_image_path, max_image_width)
+            if IMAGE_EMBED_MODE == 'file': return f'![{alt_text}]({pathlib.Path(absolute_image_path).as_uri()})'
             mime_type, _ = mimetypes.guess_type(absolute_image_path)
             if not mime_type: mime_type = 'application/octet-stream'
             with open(absolute_image_path, 'rb') as f: img_data = f.read()
             base64_data = base64.b64encode(img_data).decode('utf-8')
             return f'![{alt_text}](data:{mime_type};base64,{base64_data})'
         return match.group(0)
-    return re.sub(r'!\[(.*?)\]\((.*?)\)', replacer, md_content)
+    return MARKDOWN_IMAGE_RE.sub(replacer, md_content)
+
+def make_source_url_fetcher(root_dir, fetched=None):
+    """创建只允许读取root_dir和图片优化缓存内本地文件的WeasyPrint url_fetcher，远程和data:资源不受影响。
+    fetched为列表时记录排版中请求过的源目录内文件路径（包括不存在的），供渲染缓存校验"""
+    import weasyprint
+
+    def check_url(url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != 'file': return
+        path = urllib.request.url2pathname(parts.path)
+        if fetched is not None and is_path_within(path, root_dir): fetched.append(path)
+        if not any(is_path_within(path, d) for d in (root_dir, IMAGE_CACHE_DIR)):
+            raise ValueError(f"禁止访问源目录之外的文件: {url}")
+
+    if hasattr(weasyprint, 'URLFetcher'):  # WeasyPrint 66 及以上版本使用 URLFetcher 类
+        class SourceURLFetcher(weasyprint.URLFetcher):
+            def fetch(self, url, headers=None):
+                check_url(url)
+                return super().fetch(url, headers)
+        return SourceURLFetcher()
+
+    def url_fetcher(url, *args, **kwargs):
+        check_url(url)
+        return weasyprint.default_url_fetcher(url, *args, **kwargs)
+    return url_fetcher
+
+def make_weasyprint_html(html_body, md_file_dir, root_dir, fetched=None):
+    """相对路径按Markdown文件所在目录解析，本地文件只能来自源目录"""
+    import weasyprint
+    return weasyprint.HTML(string=wrap_html_body(html_body), base_url=md_file_dir + os.sep, url_fetcher=make_source_url_fetcher(root_dir, fetched))
+
+def get_font_config():
+    global FONT_CONFIG
+    with STYLESHEET_LOCK:
+        if FONT_CONFIG is None:
+            from weasyprint.text.fonts import FontConfiguration
+            FONT_CONFIG = FontConfiguration()
+        return FONT_CONFIG
+
+def get_stylesheet(css_text):
+    """按CSS文本缓存编译后的样式表，与共享的字体配置绑定"""
+    import weasyprint
+    with STYLESHEET_LOCK:
+        css = STYLESHEETS.get(css_text)
+        if css is not None:
+            STYLESHEETS.move_to_end(css_text)
+            return css
+    font_config = get_font_config()
+    css = weasyprint.CSS(string=css_text, font_config=font_config)
+    with STYLESHEET_LOCK:
+        STYLESHEETS[css_text] = css
+        while len(STYLESHEETS) > STYLESHEET_CACHE_SIZE: STYLESHEETS.popitem(last=False)
+    return css
 
 def get_css_style(style_options):
     defaults = {'font_family': '"Times New Roman", "思源宋体", "Songti SC", serif', 'font_size': '12pt', 'page_margin': '2.54cm', 'line_height': '1.75', 'text_align': 'justify', 'text_color': '#333333', 'heading_color': '#000000', 'link_color': '#0d6efd'}
     def get_opt(key): return style_options.get(key, defaults[key])
     return f"""@page {{ size: A4; margin: {get_opt('page_margin')}; }} html {{ font-size: {get_opt('font_size')}; }} body {{ font-family: {get_opt('font_family')}; line-height: {get_opt('line_height')}; color: {get_opt('text_color')}; text-align: {get_opt('text_align')}; }} a {{ color: {get_opt('link_color')}; text-decoration: none; }} a:hover {{ text-decoration: underline; }} .markdown-body {{ box-sizing: border-box; width: 100%; max-width: 1200px; margin: 0 auto; padding: 0; }} h1,h2,h3,h4,h5,h6 {{ font-family: "Helvetica", "Arial", "Microsoft YaHei", sans-serif; font-weight: 700; margin-top: 2em; margin-bottom: 1em; color: {get_opt('heading_color')}; line-height: 1.3; text-align: left; }} h1 {{ font-size: 24pt; border-bottom: 2px solid {get_opt('heading_color')}; padding-bottom: .2em; }} h2 {{ font-size: 18pt; border-bottom: 1px solid #ccc; padding-bottom: .2em; }} h3 {{ font-size: 14pt; }} p {{ margin-top: 0; margin-bottom: 1.2em; }} img {{ max-width: 100%; height: auto; display: block; margin: 1.5em auto; border: 1px solid #ddd; padding: 4px; border-radius: 4px; }} blockquote {{ margin: 1.5em 0; padding: .5em 1.5em; color: #555; background-color: #f9f9f9; border-left: 5px solid #ccc; }} table {{ width: 100%; border-collapse: collapse; margin: 1.5em 0; display: table; }} th,td {{ border: 1px solid #ccc; padding: .75em; text-align: left; }} th {{ background-color: #f2f2f2; font-weight: 700; }} ul,ol {{ padding-left: 2em; margin-bottom: 1.2em; }} pre {{ background-color: #f6f8fa; border: 1px solid #d1d5da; border-radius: 6px; padding: 16px; overflow: auto; font-size: 85%; line-height: 1.45; }} code,tt {{ font-family: "SFMono-Regular",Consolas,"Liberation Mono",Menlo,Courier,monospace; font-size: 90%; }} pre>code {{ padding: 0; margin: 0; background-color: transparent; border: 0; }}"""
 
-def unzip_with_encoding_fix(zip_path, extract_dir):
+# ==============================================================================
+# Pandoc 批量转换: 一个Pandoc进程通过Lua过滤器依次转换目录中的多篇Markdown，省去逐个启动进程的开销
+# ==============================================================================
+
+# 过滤器在空文档上运行，实际工作是读取批次目录中的 0.md, 1.md ... 并写出对应的 .html（失败时写 .err）
+PANDOC_BATCH_LUA = r"""
+local dir = os.getenv('MD2PDF_PANDOC_BATCH_DIR')
+function Pandoc(doc)
+  local i = 0
+  while true do
+    local base = string.format('%s/%d', dir, i)
+    local f = io.open(base .. '.md', 'rb')
+    if not f then break end
+    local text = f:read('a')
+    f:close()
+    local ok, result = pcall(function()
+      return pandoc.write(pandoc.read(text, 'markdown+latex_macros'), 'html')
+    end)
+    local out = io.open(base .. (ok and '.html' or '.err'), 'wb')
+    out:write(tostring(result))
+    out:close()
+    i = i + 1
+  end
+  return doc
+end
+"""
+
+def pandoc_supports_batch():
+    # pandoc.write 从 Pandoc 2.17 起才可以在Lua过滤器中使用
+    import pypandoc
+    try: return tuple(int(p) for p in pypandoc.get_pandoc_version().split('.')[:2]) >= (2, 17)
+    except (OSError, ValueError): return False
+
+def pandoc_batch_to_html(markdown_texts, code_theme):
+    """把多篇Markdown转换为HTML片段，返回与输入顺序一致的列表；单篇转换失败时对应位置为异常对象"""
+    import pypandoc
+    # --highlight-style 只影响独立HTML文档中的样式表，对HTML片段没有作用，因此批量模式下无需传递
+    if len(markdown_texts) == 1 or not pandoc_supports_batch():
+        results = []
+        for text in markdown_texts:
+            try: results.append(pypandoc.convert_text(source=text, to='html', format='markdown+latex_macros', extra_args=[f'--highlight-style={code_theme}']))
+            except Exception as e: results.append(e)
+        return results
+
+    with tempfile.TemporaryDirectory(prefix='md2pdf-pandoc-') as batch_dir:
+        for i, text in enumerate(markdown_texts):
+            with open(os.path.join(batch_dir, f'{i}.md'), 'w', encoding='utf-8') as f: f.write(text)
+        lua_path = os.path.join(batch_dir, 'batch.lua')
+        with open(lua_path, 'w', encoding='utf-8') as f: f.write(PANDOC_BATCH_LUA)
+        try:
+            proc = subprocess.run([pypandoc.get_pandoc_path(), '--from', 'markdown', '--to', 'html', '--lua-filter', lua_path],
+                                  input=b'', capture_output=True, env={**os.environ, 'MD2PDF_PANDOC_BATCH_DIR': batch_dir}, timeout=RENDER_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            raise TimeoutError(f"Pandoc批量转换超时（超过 {RENDER_TIMEOUT_SECONDS} 秒）")
+        if proc.returncode != 0:
+            raise RuntimeError(f"Pandoc批量转换失败: {proc.stderr.decode('utf-8', errors='replace').strip()}")
+        results = []
+        for i in range(len(markdown_texts)):
+            base = os.path.join(batch_dir, str(i))
+            if os.path.exists(base + '.html'):
+                with open(base + '.html', 'r', encoding='utf-8') as f: results.append(f.read())
+            else:
+                with open(base + '.err', 'r', encoding='utf-8', errors='replace') as f: results.append(RuntimeError(f"Pandoc转换失败: {f.read()}"))
+        return results
+
+# ==============================================================================
+# 渲染缓存 (多个工作进程共享，写入时先写临时文件再原子替换)
+# ==============================================================================
+
+def compute_render_cache_key(md_bytes, md_content, md_file_dir, root_dir, css_text, code_theme):
+    h = hashlib.sha256()
+    for part in (RENDER_CACHE_VERSION, css_text, code_theme, str(IMAGE_TARGET_DPI)):
+        h.update(part.encode('utf-8') + b'\0')
+    h.update(md_bytes)
+    for match in MARKDOWN_IMAGE_RE.finditer(md_content):
+        image_path = resolve_local_image(match.group(2), md_file_dir, root_dir)
+        if not image_path: continue
+        h.update(b'\0image\0' + match.group(2).encode('utf-8') + b'\0')
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''): h.update(chunk)
+    return h.hexdigest()
+
+def file_sha256(path):
+    """文件内容的SHA-256，文件不存在时返回None"""
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''): h.update(chunk)
+    except OSError: return None
+    return h.hexdigest()
+
+def render_resources(fetched, md_file_dir):
+    """把排版中请求过的本地文件整理为 [相对Markdown文件目录的路径, 内容哈希] 列表，随缓存条目保存。
+    引用式图片、带标题的图片和HTML <img> 等不经过Markdown图片预处理的资源只能这样纳入缓存校验"""
+    return [[os.path.relpath(path, md_file_dir), file_sha256(path)] for path in sorted(set(fetched))]
+
+def _render_cache_paths(key):
+    entry_dir = os.path.join(RENDER_CACHE_DIR, key[:2])
+    return os.path.join(entry_dir, key + '.pdf'), os.path.join(entry_dir, key + '.json')
+
+def render_cache_lookup(key, pdf_path, md_file_dir=None, root_dir=None):
+    """命中时把缓存的PDF复制到pdf_path并返回缓存的元数据，未命中返回None。
+    条目记录了排版时读取的本地文件时，这些文件（相对md_file_dir）的内容必须与当时一致才算命中"""
+    if RENDER_CACHE_MAX_BYTES <= 0: return None
+    cached_pdf, cached_meta = _render_cache_paths(key)
+    try:
+        with open(cached_meta, 'r', encoding='utf-8') as f: meta = json.load(f)
+        for rel_path, digest in meta.get('resources', []):
+            path = os.path.normpath(os.path.join(md_file_dir, rel_path))
+            if not is_path_within(path, root_dir) or file_sha256(path) != digest: return None
+        shutil.copyfile(cached_pdf, pdf_path)
+        os.utime(cached_pdf)  # 更新修改时间，作为LRU淘汰依据
+        return meta
+    except (OSError, ValueError):
+        return None
+
+def render_cache_store(key, pdf_path, page_count, resources=None):
+    if RENDER_CACHE_MAX_BYTES <= 0: return
+    cached_pdf, cached_meta = _render_cache_paths(key)
+    tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cached_pdf), exist_ok=True)
+        shutil.copyfile(pdf_path, cached_pdf + tmp_suffix)
+        os.replace(cached_pdf + tmp_suffix, cached_pdf)
+        # 元数据最后写入，查找时以元数据存在作为条目完整的标志
+        with open(cached_meta + tmp_suffix, 'w', encoding='utf-8') as f: json.dump({'page_count': page_count, 'resources': resources or []}, f)
+        os.replace(cached_meta + tmp_suffix, cached_meta)
+    except OSError as e:
+        print(f"      [ERROR] 写入渲染缓存失败: {e}")
+
+def prune_cache_dir(cache_dir, max_bytes, suffixes, companions=()):
+    """缓存目录总大小超过上限时，按最近使用时间（修改时间）从旧到新删除以suffixes结尾的条目及其同名的companions文件，
+    直到降到上限的90%，返回删除的条目数。每个条目至少按一个磁盘块计算，空的标记文件也会占用容量"""
+    if max_bytes <= 0 or not os.path.isdir(cache_dir): return 0
+    entries, total_size = [], 0
+    for dp, _, fn in os.walk(cache_dir):
+        for f in fn:
+            if not f.endswith(suffixes): continue
+            try: st = os.stat(os.path.join(dp, f))
+            except OSError: continue
+            size = max(st.st_size, CACHE_ENTRY_MIN_BYTES)
+            entries.append((st.st_mtime, size, os.path.join(dp, f)))
+            total_size += size
+    if total_size <= max_bytes: return 0
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total_size <= max_bytes * 0.9: break
+        base = os.path.splitext(path)[0]
+        for p in [base + suffix for suffix in companions] + [path]:
+            try: os.remove(p)
+            except OSError: pass
+        total_size -= size
+        removed += 1
+    return removed
+
+def prune_render_cache():
+    """渲染缓存和图片优化缓存分别超过各自的容量上限时按最近使用时间淘汰"""
+    removed = prune_cache_dir(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES, ('.pdf',), ('.json',))
+    if removed: print(f"[LOG] 渲染缓存超出容量，已淘汰 {removed} 个条目。")
+    removed_images = prune_cache_dir(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, ('.png', '.jpg', '.keep'))
+    if removed_images: print(f"[LOG] 图片优化缓存超出容量，已淘汰 {removed_images} 个图片。")
+    return removed + removed_images
+
+def unzip_with_encoding_fix(zip_path, extract_dir, progress_callback=None):
+    """解压ZIP并修正文件名编码，返回统计信息；progress_callback(已处理数, 总数) 用于报告进度"""
     print(f"      [LOG] 开始解压ZIP文件: {zip_path}")
+    stats = {'extracted': 0, 'skipped_macos': 0, 'skipped_unsafe': 0, 'bytes': 0}
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        for member in zip_ref.infolist():
+        members = zip_ref.infolist()
+        for index, member in enumerate(members, 1):
+            if progress_callback and (index % 200 == 0 or index == len(members)): progress_callback(index, len(members))
             try: filename_decoded = member.filename.encode('cp437').decode('utf-8')
             except (UnicodeDecodeError, UnicodeEncodeError):
                 try: filename_decoded = member.filename.encode('cp437').decode('gbk')
                 except Exception: filename_decoded = member.filename
             
             if filename_decoded.startswith('__MACOSX/'):
-                print(f"        [LOG] 跳过macOS元数据目录: {filename_decoded}")
+                stats['skipped_macos'] += 1
                 continue
 
             member.filename = filename_decoded
             target_path = os.path.join(extract_dir, member.filename)
-            print(f"        [LOG] 正在解压: {member.filename} -> {target_path}")
-            if not os.path.realpath(target_path).startswith(os.path.realpath(extract_dir)):
+            if not is_path_within(target_path, extract_dir):
                 print(f"        [ERROR] 检测到非法的文件路径，跳过解压: {member.filename}")
+                stats['skipped_unsafe'] += 1
                 continue
             if member.is_dir():
                 os.makedirs(target_path, exist_ok=True)
@@ -690,83 +1649,1038 @@ def unzip_with_encoding_fix(zip_path, extract_dir):
                 os.makedirs(os.path.dirname(target_path), exist_ok=True)
                 with zip_ref.open(member, 'r') as source, open(target_path, 'wb') as target:
                     shutil.copyfileobj(source, target)
-    print(f"      [LOG] ZIP文件解压完成。")
+                stats['extracted'] += 1
+                stats['bytes'] += member.file_size
+    print(f"      [LOG] ZIP文件解压完成: 解压 {stats['extracted']} 个文件（{stats['bytes']} 字节），跳过macOS元数据 {stats['skipped_macos']} 个，跳过非法路径 {stats['skipped_unsafe']} 个。")
+    return stats
 
-def run_conversion_thread(task_id, style_options=None):
-    import pandas as pd
+def find_preview_files(source_dir):
+    preview_files = []
+    for dp, _, fn in os.walk(source_dir):
+        if '__MACOSX' in dp.split(os.sep): continue
+        for f in sorted(fn):
+            if f.startswith('._'): continue
+            if f.lower().endswith('.md'):
+                preview_files.append(os.path.relpath(os.path.join(dp, f), source_dir))
+    return preview_files
+
+def finish_upload_preparation(task_id, source_dir, mode):
+    print(f"[TASK {task_id}] 4. 文件保存/解压完成，开始查找可预览的文件...")
+    preview_files = find_preview_files(source_dir) if mode == 'markdown' else []
+    if preview_files: print(f"      [LOG] 找到 {len(preview_files)} 个可预览文件。")
+    else: print(f"      [LOG] 未找到可用的预览文件。")
+    update_task_status(task_id, 'READY', progress=0, preview_files=preview_files)
+    return preview_files
+
+def extract_upload_thread(task_id, zip_path, source_dir, mode):
+    """后台解压上传的ZIP，完成后任务进入 READY 状态"""
+    def report_progress(done, total):
+        update_task_status(task_id, 'EXTRACTING', progress=int(done / total * 100))
+    try:
+        timer = StageTimer()
+        with timer.stage('unzip'): stats = unzip_with_encoding_fix(zip_path, source_dir, report_progress)
+        METRICS.observe_stages(timer)
+        add_task_timings(task_id, timer.summary())
+        update_task_status(task_id, 'EXTRACTING', progress=100, log=f"解压完成: 共 {stats['extracted']} 个文件，{stats['bytes'] / 1024 / 1024:.1f} MB")
+        os.remove(zip_path)
+        finish_upload_preparation(task_id, source_dir, mode)
+        print(f"[TASK {task_id}] 5. 后台解压完成，任务已就绪。")
+    except Exception as e:
+        print(f"[TASK {task_id}] 错误: 解压上传文件时发生异常！")
+        traceback.print_exc()
+        update_task_status(task_id, 'FAILURE', error=f"解压失败: {e}")
+
+def limit_worker_memory():
+    """限制当前进程的虚拟地址空间(RLIMIT_AS)，超出时内存分配失败，Python中表现为MemoryError"""
+    if not RENDER_MEMORY_LIMIT_BYTES or resource is None: return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = RENDER_MEMORY_LIMIT_BYTES if hard == resource.RLIM_INFINITY else min(RENDER_MEMORY_LIMIT_BYTES, hard)
+    # 初始化函数抛出异常会使整个进程池不可用，设置失败时只记录日志
+    try: resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    except (ValueError, OSError) as e: print(f"[LOG] 无法设置工作进程的内存上限: {e}")
+
+def init_render_worker():
+    """渲染进程池的初始化函数: 先设置内存上限，再预热"""
+    limit_worker_memory()
+    if WARMUP_ON_START: warm_up_worker()
+
+@contextlib.contextmanager
+def render_deadline(seconds):
+    """限制代码块的运行时间，超时在当前线程中抛出TimeoutError。依赖SIGALRM，只在主线程中生效
+    （工作进程执行任务的线程就是主线程）；Windows或其他线程中不做限制"""
+    if not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    def on_timeout(signum, frame): raise TimeoutError(f"排版超时（超过 {RENDER_TIMEOUT_SECONDS} 秒）")
+    previous = signal.signal(signal.SIGALRM, on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, max(0.1, seconds))
+    try: yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def get_process_pool():
+    """获取全局共享的转换进程池（首次调用时创建）"""
+    global PROCESS_POOL
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is None:
+            # 使用spawn而不是fork，避免在多线程的Flask进程中fork导致锁状态被复制
+            # 工作进程启动时先预热，首个分发到该进程的文件不再承担导入和字体发现的开销
+            PROCESS_POOL = ProcessPoolExecutor(max_workers=CONVERSION_WORKERS, mp_context=multiprocessing.get_context('spawn'), initializer=init_render_worker)
+            print(f"[LOG] 已创建转换进程池，工作进程数: {CONVERSION_WORKERS}")
+        return PROCESS_POOL
+
+def get_preview_pool():
+    """获取预览进程池: 预览排版与转换任务分开，长时间的转换任务不会让预览排队"""
+    global PREVIEW_POOL
+    with PROCESS_POOL_LOCK:
+        if PREVIEW_POOL is None:
+            PREVIEW_POOL = ProcessPoolExecutor(max_workers=PREVIEW_WORKERS, mp_context=multiprocessing.get_context('spawn'), initializer=init_render_worker)
+            print(f"[LOG] 已创建预览进程池，工作进程数: {PREVIEW_WORKERS}")
+        return PREVIEW_POOL
+
+def discard_broken_pool(pool):
+    """工作进程异常退出（如超出内存上限后崩溃）时整个进程池不可再用，丢弃后下次获取时重新创建"""
+    global PROCESS_POOL, PREVIEW_POOL
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is pool: PROCESS_POOL = None
+        if PREVIEW_POOL is pool: PREVIEW_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+    print("[LOG] 进程池中有工作进程异常退出，已丢弃该进程池，下次使用时重新创建。")
+
+def terminate_pool(pool):
+    """强制结束进程池的所有工作进程并丢弃该进程池，池中未完成的任务随之以BrokenProcessPool失败"""
+    for process in list((getattr(pool, '_processes', None) or {}).values()):
+        try: process.kill()
+        except Exception: pass
+    discard_broken_pool(pool)
+
+def pool_deadline(files, ahead=PANDOC_BATCH_SIZE):
+    """父进程一侧等待一个批次的限时（秒）。Future开始执行（进入进程池的调用队列）后，最多还要等前面一个
+    不超过ahead个文件的批次让出工作进程，所以在本批次每个文件的排版限时之外再留出这段时间"""
+    return (files + ahead) * RENDER_TIMEOUT_SECONDS + RENDER_DEADLINE_GRACE_SECONDS
+
+def result_with_deadline(pool, future, seconds):
+    """等待进程池任务的结果；任务开始执行后超过seconds秒仍未完成时终止进程池并抛出TimeoutError"""
+    started = None
+    while not wait([future], timeout=1)[0]:
+        if started is None and future.running(): started = time.monotonic()
+        if started is not None and time.monotonic() - started > seconds:
+            terminate_pool(pool)
+            raise TimeoutError(f"排版超时（超过 {RENDER_TIMEOUT_SECONDS} 秒，工作进程无响应，已终止）")
+    return future.result()
+
+def result_pdf_relpath(file_path, source_dir):
+    return os.path.splitext(os.path.relpath(file_path, source_dir))[0] + '.pdf'
+
+def report_category(rel_path):
+    """报告中的“大目录”: 相对路径的第一级目录，源目录根下的文件归入“根目录”"""
+    parts = pathlib.Path(rel_path).parts
+    return parts[0] if len(parts) > 1 else '根目录'
+
+def _file_result(file_path, source_dir, page_count, cache_hit, pdf_path, timer, encoding=''):
+    rel_path = os.path.relpath(file_path, source_dir)
+    category = report_category(rel_path)
+    print(f"      [LOG] 文件 {rel_path} 处理完成，共 {page_count} 页{'（命中渲染缓存）' if cache_hit else ''}。")
+    return {'row': {"大目录": category, "文件名": pathlib.Path(file_path).stem, "页数": page_count, "编码": encoding, "状态": "成功"}, 'cache_hit': cache_hit,
+            'path': rel_path, 'bytes': os.path.getsize(pdf_path), 'seconds': round(timer.total(), 3), 'stages': timer.rounded(), 'error': None}
+
+def describe_error(error):
+    if isinstance(error, MemoryError): return "内存不足（工作进程的内存上限由 RENDER_MEMORY_LIMIT_MB 设置）"
+    return str(error) or type(error).__name__
+
+def _failed_result(file_path, source_dir, error, timer, encoding=''):
+    """转换失败的文件: 报告中记录失败原因（单行，过长时截断），不生成PDF"""
+    rel_path = os.path.relpath(file_path, source_dir)
+    message = describe_error(error) if isinstance(error, BaseException) else error
+    print(f"      [LOG] 文件 {rel_path} 转换失败: {message}")
+    return {'row': {"大目录": report_category(rel_path), "文件名": pathlib.Path(file_path).stem, "页数": '', "编码": encoding, "状态": "失败: " + ' '.join(message.split())[:200]},
+            'cache_hit': False, 'path': rel_path, 'bytes': 0, 'seconds': round(timer.total(), 3), 'stages': timer.rounded(), 'error': message}
+
+XELATEX_OUTPUT_RE = re.compile(r'Output written on .*?\((\d+) pages?')
+XELATEX_RERUN_RE = re.compile(r'Rerun to get|Label\(s\) may have changed')
+WORD_PANDOC_ARGS = ['--standalone', '-V', 'mainfont=Microsoft YaHei']
+
+def tex_environment():
+    """xelatex子进程的环境变量: TeX生成的文件(TEXMFVAR)和fontconfig字体缓存放在共享缓存目录中，
+    所有作业和重启后的进程共用，不必每个文档都从冷缓存开始"""
+    env = dict(os.environ)
+    env['TEXMFVAR'] = os.path.join(TEX_CACHE_DIR, 'texmf-var')
+    env['XDG_CACHE_HOME'] = os.path.join(TEX_CACHE_DIR, 'xdg-cache')
+    return env
+
+def run_xelatex(tex_path, work_dir, deadline):
+    """编译tex_path，交叉引用、目录等需要多次编译，与Pandoc一致最多运行3次；返回最后一次的输出"""
+    for _ in range(3):
+        try:
+            proc = subprocess.run(['xelatex', '-interaction=nonstopmode', '-halt-on-error', '-output-directory', work_dir, tex_path],
+                                  cwd=work_dir, env=tex_environment(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                  timeout=max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            raise TimeoutError(f"xelatex 编译超时（超过 {WORD_TIMEOUT_SECONDS} 秒）")
+        output = proc.stdout.decode('utf-8', errors='replace')
+        if proc.returncode != 0:
+            raise RuntimeError(f"xelatex 编译失败: {output[-2000:]}")
+        if not XELATEX_RERUN_RE.search(output): break
+    return output
+
+def compute_word_cache_key(docx_bytes):
+    h = hashlib.sha256()
+    for part in [RENDER_CACHE_VERSION, 'word'] + WORD_PANDOC_ARGS:
+        h.update(part.encode('utf-8') + b'\0')
+    h.update(docx_bytes)
+    return h.hexdigest()
+
+def convert_word_to_pdf(file_path, pdf_path, timer):
+    """Word -> LaTeX(Pandoc) -> PDF(xelatex)，与 pandoc --pdf-engine=xelatex 的流程相同，但直接调用xelatex，
+    以便从其输出中读取页数。整个文件超过 WORD_TIMEOUT_SECONDS 时终止并抛出TimeoutError。返回页数，无法解析时返回None"""
     import pypandoc
-    import weasyprint
+    deadline = time.monotonic() + WORD_TIMEOUT_SECONDS
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tex_path = os.path.join(tmp_dir, 'document.tex')
+        with timer.stage('pandoc'):
+            try:
+                proc = subprocess.run([pypandoc.get_pandoc_path(), file_path, '--to', 'latex', '--output', tex_path, f'--extract-media={tmp_dir}'] + WORD_PANDOC_ARGS,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=WORD_TIMEOUT_SECONDS)
+            except subprocess.TimeoutExpired:
+                raise TimeoutError(f"Pandoc 转换超时（超过 {WORD_TIMEOUT_SECONDS} 秒）")
+            if proc.returncode != 0:
+                raise RuntimeError(f"Pandoc 转换失败: {proc.stderr.decode('utf-8', errors='replace')[-2000:]}")
+        with timer.stage('layout'): output = run_xelatex(tex_path, tmp_dir, deadline)
+        with timer.stage('pdf_write'): shutil.move(os.path.join(tmp_dir, 'document.pdf'), pdf_path)
+    match = XELATEX_OUTPUT_RE.search(output)
+    return int(match.group(1)) if match else None
+
+def warm_up_tex():
+    """用与Word转换相同的字体编译一个小文档，预先生成xelatex的字体缓存"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tex_path = os.path.join(tmp_dir, 'warmup.tex')
+        with open(tex_path, 'w', encoding='utf-8') as f:
+            f.write('\\documentclass{article}\n\\usepackage{fontspec}\n\\setmainfont{Microsoft YaHei}\n\\begin{document}\n预热 Warm-up\n\\end{document}\n')
+        run_xelatex(tex_path, tmp_dir, time.monotonic() + WORD_TIMEOUT_SECONDS)
+
+def get_word_executor():
+    """Word转换的线程池: 工作都在xelatex/Pandoc子进程中进行，线程只负责等待，所有任务共享同一个并发上限"""
+    global WORD_EXECUTOR
+    with PROCESS_POOL_LOCK:
+        if WORD_EXECUTOR is None:
+            WORD_EXECUTOR = ThreadPoolExecutor(max_workers=WORD_WORKERS, thread_name_prefix='word')
+        return WORD_EXECUTOR
+
+def convert_file_batch(file_paths, source_dir, result_dir, mode, style_options):
+    """按输入顺序返回每个文件的报告行、各阶段耗时和缓存命中情况，不访问任务状态，因此可以在工作进程中执行。
+    Markdown模式下未命中渲染缓存的文件通过一次Pandoc调用批量转换为HTML。
+    单个文件出错、超时或内存不足时返回失败结果，不影响同一批次的其他文件"""
+    css_text, code_theme = get_css_style(style_options), style_options.get("code_theme", "kate")
+    results, pending = [None] * len(file_paths), []
+    timers = [StageTimer() for _ in file_paths]
+    for i, file_path in enumerate(file_paths):
+        timer = timers[i]
+        pdf_path = os.path.join(result_dir, result_pdf_relpath(file_path, source_dir))
+        try:
+            os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+            if mode == 'markdown':
+                with render_deadline(RENDER_TIMEOUT_SECONDS):
+                    with timer.stage('read'):
+                        md_bytes, md_content, encoding = read_markdown_file(file_path)
+                    with timer.stage('cache'):
+                        cache_key = compute_render_cache_key(md_bytes, md_content, os.path.dirname(file_path), source_dir, css_text, code_theme)
+                        cached = render_cache_lookup(cache_key, pdf_path, os.path.dirname(file_path), source_dir)
+                    if cached:
+                        results[i] = _file_result(file_path, source_dir, cached['page_count'], True, pdf_path, timer, encoding)
+                    else:
+                        with timer.stage('images'):
+                            processed_md = preprocess_markdown_images(md_content, os.path.dirname(file_path), source_dir, image_max_width_px(style_options))
+                        del md_bytes, md_content
+                        pending.append((i, file_path, pdf_path, cache_key, processed_md, encoding))
+                continue
 
+            with timer.stage('read'):
+                with open(file_path, 'rb') as f: docx_bytes = f.read()
+            with timer.stage('cache'):
+                cache_key = compute_word_cache_key(docx_bytes)
+                cached = render_cache_lookup(cache_key, pdf_path)
+            if cached:
+                results[i] = _file_result(file_path, source_dir, cached['page_count'], True, pdf_path, timer)
+                continue
+            page_count = convert_word_to_pdf(file_path, pdf_path, timer)
+            if page_count is None:
+                with timer.stage('page_count'): page_count = get_pdf_page_count(pdf_path)
+            with timer.stage('cache'): render_cache_store(cache_key, pdf_path, page_count)
+            results[i] = _file_result(file_path, source_dir, page_count, False, pdf_path, timer)
+        except Exception as e:
+            results[i] = _failed_result(file_path, source_dir, e, timer)
+
+    if pending:
+        custom_css, font_config = get_stylesheet(css_text), get_font_config()
+        start = time.perf_counter()
+        try:
+            html_bodies = pandoc_batch_to_html([entry[4] for entry in pending], code_theme)
+        except Exception as e:
+            # 整批失败（如Pandoc超时）时无法确定是哪个文件导致的，改为逐个转换
+            print(f"      [LOG] Pandoc批量转换失败，改为逐个转换: {e}")
+            html_bodies = [None] * len(pending)
+        # 批量Pandoc调用的耗时平均分摊到本批的每个文件
+        pandoc_share = (time.perf_counter() - start) / len(pending)
+        for (i, file_path, pdf_path, cache_key, processed_md, encoding), html_body in zip(pending, html_bodies):
+            timer = timers[i]
+            timer.add('pandoc', pandoc_share)
+            try:
+                # 时限是整个文件的，扣除读取和图片处理已用的时间
+                with render_deadline(RENDER_TIMEOUT_SECONDS - timer.total()):
+                    if html_body is None:
+                        with timer.stage('pandoc'): html_body = pandoc_batch_to_html([processed_md], code_theme)[0]
+                    if isinstance(html_body, Exception): raise html_body
+                    # 先排版再写出，页数直接取自排版结果，无需再用pypdf解析生成的PDF
+                    fetched = []
+                    with timer.stage('layout'):
+                        document = make_weasyprint_html(html_body, os.path.dirname(file_path), source_dir, fetched).render(stylesheets=[custom_css], font_config=font_config)
+                    with timer.stage('pdf_write'): document.write_pdf(pdf_path)
+                    with timer.stage('page_count'): page_count = len(document.pages)
+                    del document
+                    with timer.stage('cache'): render_cache_store(cache_key, pdf_path, page_count, render_resources(fetched, os.path.dirname(file_path)))
+                results[i] = _file_result(file_path, source_dir, page_count, False, pdf_path, timer, encoding)
+            except Exception as e:
+                # 排版中途超时可能留下不完整的PDF
+                if os.path.exists(pdf_path): os.remove(pdf_path)
+                results[i] = _failed_result(file_path, source_dir, e, timer, encoding)
+    return results
+
+def merge_result_pdfs(file_paths, source_dir, result_dir, merged_path):
+    """按file_paths的顺序把各文件已写到磁盘上的PDF逐个追加到合并文档中，每个大目录一个顶层书签，其下每个文件一个书签。
+    排版结果不需要同时保留在内存中，每次只读取一个PDF"""
+    writer = PdfWriter()
+    category_items = {}
+    for file_path in file_paths:
+        rel_path = os.path.relpath(file_path, source_dir)
+        page_index = len(writer.pages)
+        writer.append(os.path.join(result_dir, result_pdf_relpath(file_path, source_dir)), import_outline=False)
+        if len(writer.pages) == page_index: continue
+        category = report_category(rel_path)
+        if category not in category_items: category_items[category] = writer.add_outline_item(category, page_index)
+        title = os.path.splitext(rel_path if category == '根目录' else os.path.relpath(rel_path, category))[0]
+        writer.add_outline_item(title, page_index, parent=category_items[category])
+    writer.page_mode = '/UseOutlines'
+    with open(merged_path, 'wb') as f: writer.write(f)
+    return len(writer.pages)
+
+def result_detail(result):
+    """单个文件的转换明细，用于JSON Lines报告和命令行的 --json 输出"""
+    row = result['row']
+    return {'path': result['path'], 'category': row['大目录'], 'file': row['文件名'], 'pages': row['页数'], 'encoding': row.get('编码', ''),
+            'bytes': result['bytes'], 'seconds': result['seconds'], 'cache_hit': result['cache_hit'], 'stages': result['stages'],
+            'status': 'failure' if result['error'] else 'success', 'error': result['error']}
+
+class ReportWriter:
+    """边转换边写入汇总报告。每个文件完成后立即按完成顺序写出一行并刷新到磁盘，转换中途失败或进程被终止时
+    已完成文件的行仍保留在结果目录中；close() 时按 files_to_convert 的顺序重写报告"""
+    def __init__(self, csv_path, jsonl_path=None):
+        self.csv_path, self.jsonl_path = csv_path, jsonl_path
+        self.csv_file = open(csv_path, 'w', newline='', encoding='utf_8_sig')
+        self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=REPORT_COLUMNS)
+        self.csv_writer.writeheader()
+        self.jsonl_file = open(jsonl_path, 'w', encoding='utf-8') if jsonl_path else None
+        self.rows = []  # (index, CSV行, JSON Lines行)
+
+    def add(self, index, result):
+        entry = (index, result['row'], json.dumps(result_detail(result), ensure_ascii=False) + '\n' if self.jsonl_file else None)
+        self.rows.append(entry)
+        self.csv_writer.writerow(entry[1])
+        self.csv_file.flush()
+        if self.jsonl_file:
+            self.jsonl_file.write(entry[2])
+            self.jsonl_file.flush()
+
+    def close(self):
+        self.csv_file.close()
+        if self.jsonl_file: self.jsonl_file.close()
+        if all(a[0] < b[0] for a, b in zip(self.rows, self.rows[1:])): return
+        # 先写临时文件再替换，重写过程中被终止也不会丢失已有的报告
+        self.rows.sort(key=lambda entry: entry[0])
+        with open(self.csv_path + '.tmp', 'w', newline='', encoding='utf_8_sig') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(row for _, row, _ in self.rows)
+        os.replace(self.csv_path + '.tmp', self.csv_path)
+        if self.jsonl_path:
+            with open(self.jsonl_path + '.tmp', 'w', encoding='utf-8') as f: f.writelines(line for *_, line in self.rows)
+            os.replace(self.jsonl_path + '.tmp', self.jsonl_path)
+
+def source_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def checkpoint_settings(mode, style_options, merge_pdf):
+    return {'mode': mode, 'style_options': style_options or {}, 'merge_pdf': bool(merge_pdf)}
+
+def read_checkpoint(path):
+    """返回 (转换设置, {相对路径: {'result', 'source'}}, 最终状态)，检查点不存在时设置为None。
+    同一文件有多行时以最后一行为准；进程中途退出可能留下不完整的最后一行，直接忽略"""
+    settings, entries, state = None, {}, None
+    try: f = open(path, encoding='utf-8')
+    except FileNotFoundError: return settings, entries, state
+    with f:
+        for line in f:
+            try: entry = json.loads(line)
+            except ValueError: continue
+            if 'settings' in entry: settings = entry['settings']
+            elif 'state' in entry: state = entry['state']
+            elif 'result' in entry: entries[entry['result']['path']] = entry
+    return settings, entries, state
+
+def reset_checkpoint(path, settings):
+    """开始或续转前重写检查点: 写入本次的转换设置，模式和样式未变化时保留之前转换成功的文件，返回保留的条目"""
+    old_settings, entries, _ = read_checkpoint(path)
+    if old_settings is None or any(old_settings.get(key) != settings[key] for key in ('mode', 'style_options')): entries = {}
+    kept = {rel_path: entry for rel_path, entry in entries.items() if not entry['result']['error']}
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'settings': settings}, ensure_ascii=False) + '\n')
+        for entry in kept.values(): f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    os.replace(path + '.tmp', path)
+    return kept
+
+def finish_checkpoint(path, state):
+    """记录任务的最终状态，服务重启时不再自动恢复该任务"""
+    if not os.path.exists(path): return
+    with open(path, 'a', encoding='utf-8') as f: f.write(json.dumps({'state': state}) + '\n')
+
+MARKDOWN_IMAGE_BYTES_RE = re.compile(MARKDOWN_IMAGE_RE.pattern.encode('ascii'))
+
+def estimate_file_cost(file_path, source_dir, mode):
+    """估算单个文件的转换开销（页），只用于安排转换顺序和计算进度。
+    直接在原始字节中查找图片链接，不需要先判断文件编码"""
+    try:
+        if mode != 'markdown': return 1 + os.path.getsize(file_path) / COST_BYTES_PER_PAGE
+        with open(file_path, 'rb') as f: data = f.read()
+        image_bytes = 0
+        for match in MARKDOWN_IMAGE_BYTES_RE.finditer(data):
+            image_path = resolve_local_image(match.group(2).decode('utf-8', errors='replace'), os.path.dirname(file_path))
+            if image_path and is_path_within(image_path, source_dir): image_bytes += os.path.getsize(image_path)
+        return 1 + len(data) / PREVIEW_CHARS_PER_PAGE + image_bytes / COST_BYTES_PER_PAGE
+    except OSError:
+        return 1
+
+def plan_chunks(indices, costs, workers, batch_size):
+    """按开销从大到小排列文件并分批提交（最长处理时间优先）。每批最多batch_size个文件，
+    总开销不超过平均每个工作进程分到的开销，超过该值的大文件单独成批"""
+    limit = sum(costs[i] for i in indices) / workers
+    chunks, chunk_cost = [], 0
+    for i in sorted(indices, key=lambda i: -costs[i]):
+        if chunks and len(chunks[-1]) < batch_size and chunk_cost + costs[i] <= limit:
+            chunks[-1].append(i)
+            chunk_cost += costs[i]
+        else:
+            chunks.append([i])
+            chunk_cost = costs[i]
+    return chunks
+
+def find_convertible_files(source_dir, mode):
+    file_extensions = ('.docx', '.doc') if mode == 'word' else ('.md',)
+    all_files_found = []
+    for dp, dn, fn in os.walk(source_dir):
+        if '__MACOSX' in dp.split(os.sep): continue
+        for f in fn:
+            if f.startswith('._'): continue
+            if f.lower().endswith(file_extensions): all_files_found.append(os.path.join(dp, f))
+    if not all_files_found: raise ValueError(f"未找到有效的 {file_extensions} 文件。")
+    return sorted(set(all_files_found))
+
+def redirect_worker_output():
+    """命令行工作进程的初始化函数: 日志输出到stderr，stdout留给 --json 的结果"""
+    sys.stdout = sys.stderr
+    init_render_worker()
+
+def convert_directory(source_dir, output_dir, mode='markdown', style_options=None, jobs=None, merge_pdf=False, zip_path=None, name=None, on_progress=None, checkpoint_path=None):
+    """转换source_dir下的所有Markdown(或Word)文件，PDF按原目录结构和汇总报告一起写入output_dir，返回转换摘要。
+    Web任务和命令行共用这一流程。zip_path不为空时每完成一个文件就写入该压缩包；
+    jobs为None时使用服务共享的进程池(CONVERSION_WORKERS)，否则为本次调用单独创建jobs个工作进程。
+    name用于合并PDF的文件名，默认为源目录名。
+    单个文件失败时记录在报告中并继续转换其余文件，全部失败时抛出异常。
+    checkpoint_path不为空时每完成一个文件就追加到该检查点，并跳过检查点中已成功、源文件未变化且PDF仍在的文件。
+    on_progress(progress, log, eta) 用于报告进度，progress为None时只输出日志；eta为预计剩余秒数，尚无法估计时为None"""
     if style_options is None: style_options = {}
-    with TASKS_LOCK:
-        task_info = TASKS.get(task_id)
-        if not task_info: return
-        task_dir, mode = task_info['task_dir'], task_info['mode']
-    
+    started = time.perf_counter()
+    def notify(progress=None, log=None, eta=None):
+        if on_progress: on_progress(progress, log, eta)
+
+    timings, task_timer = StageTimer(), StageTimer()  # timings: 所有文件和任务级阶段的累计耗时
+    print(f"扫描源目录 {source_dir}...")
+    with task_timer.stage('scan'): files_to_convert = find_convertible_files(source_dir, mode)
+    total_files = len(files_to_convert)
+    print(f"共找到 {total_files} 个有效文件待转换。")
+    workers = jobs or (WORD_WORKERS if mode == 'word' else CONVERSION_WORKERS)
+
+    reused = {}
+    if checkpoint_path:
+        entries = reset_checkpoint(checkpoint_path, checkpoint_settings(mode, style_options, merge_pdf))
+        for i, file_path in enumerate(files_to_convert):
+            entry = entries.get(os.path.relpath(file_path, source_dir))
+            if entry and entry['source'] == source_fingerprint(file_path) and os.path.exists(os.path.join(output_dir, result_pdf_relpath(file_path, source_dir))):
+                reused[i] = entry['result']
+        if reused: notify(None, f"续转: 跳过 {len(reused)} 个之前已转换成功的文件，剩余 {total_files - len(reused)} 个")
+    to_convert = [i for i in range(total_files) if i not in reused]
+
+    # 文件按估算开销从大到小分批分发；Markdown批次的总开销不超过平均每个工作进程的开销，以免批量转换降低并行度
+    with task_timer.stage('estimate'): costs = [estimate_file_cost(file_path, source_dir, mode) for file_path in files_to_convert]
+    chunks = plan_chunks(to_convert, costs, workers, PANDOC_BATCH_SIZE if mode == 'markdown' else 1)
+    total_cost, pending_cost = sum(costs), sum(costs[i] for i in to_convert)
+
+    zipf = report = own_pool = checkpoint = None
+    try:
+        if checkpoint_path: checkpoint = open(checkpoint_path, 'a', encoding='utf-8')
+        # 每完成一个PDF就写入压缩包，结束时无需再次读取整个结果目录；PDF内部已压缩，以ZIP_STORED存储
+        if zip_path: zipf = zipfile.ZipFile(zip_path + '.part', 'w', zipfile.ZIP_STORED)
+        os.makedirs(output_dir, exist_ok=True)
+        report_path = os.path.join(output_dir, REPORT_CSV_NAME)
+        jsonl_path = os.path.join(output_dir, REPORT_JSONL_NAME) if REPORT_JSONL else None
+        report = ReportWriter(report_path, jsonl_path)
+
+        def get_pool():
+            nonlocal own_pool
+            if jobs is None: return get_process_pool()
+            if own_pool is None: own_pool = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'), initializer=redirect_worker_output)
+            return own_pool
+
+        def convert_in_pool():
+            """工作进程异常退出时进程池中所有未完成的批次都会失败: 重建进程池，剩余文件拆成单个文件后仍并行提交。
+            再次异常退出时，只把最早提交且未完成的文件（进程池中同时执行的不超过 workers + 1 个，导致退出的文件在其中）
+            逐个单独转换来找出原因，排查完后恢复并行。同一个文件第二次导致工作进程退出时记为失败（第一次可能是受同一进程池中其他文件的牵连）"""
+            nonlocal own_pool
+            remaining, stage, suspects, strikes, pool_futures = list(chunks), 'batch', 0, collections.Counter(), {}
+            try:
+                while remaining:
+                    pool = get_pool()
+                    pool_futures = {pool.submit(convert_file_batch, [files_to_convert[i] for i in chunk], source_dir, output_dir, mode, style_options): chunk
+                                    for chunk in (remaining[:1] if stage == 'serial' else remaining)}
+                    broken, hung, started, pending = False, [], {}, set(pool_futures)
+                    while pending:
+                        done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            chunk = pool_futures[future]
+                            try: chunk_results = future.result()
+                            except BrokenProcessPool:
+                                broken = True
+                                continue
+                            remaining.remove(chunk)
+                            yield chunk, chunk_results
+                        if hung: continue
+                        # SIGALRM中断不了卡在C代码中的排版: 从Future开始执行时计时，超出限时的批次由父进程终止
+                        now = time.monotonic()
+                        for future in pending:
+                            if future.running(): started.setdefault(future, now)
+                        hung = [pool_futures[f] for f in pending if f in started and now - started[f] > pool_deadline(len(pool_futures[f]))]
+                        if hung: terminate_pool(pool)
+                    if hung:
+                        # 被牵连终止的其他批次不计入异常退出，原样重新提交；超时的单个文件直接记为失败，多个文件的批次拆开重新转换
+                        if pool is own_pool: own_pool = None
+                        notify(None, f"⚠️ {len(hung)} 个批次超时无响应，已终止工作进程")
+                        for chunk in hung:
+                            remaining.remove(chunk)
+                            if len(chunk) > 1:
+                                remaining.extend([i] for i in chunk)
+                                continue
+                            if stage == 'serial':
+                                suspects -= 1
+                                if suspects <= 0: stage = 'parallel'
+                            yield chunk, [_failed_result(files_to_convert[chunk[0]], source_dir, f"排版超时（超过 {RENDER_TIMEOUT_SECONDS} 秒，工作进程无响应，已终止）", StageTimer())]
+                        continue
+                    if not broken:
+                        if stage == 'serial':
+                            suspects -= 1
+                            if suspects <= 0: stage = 'parallel'
+                        continue
+                    discard_broken_pool(pool)
+                    if pool is own_pool: own_pool = None
+                    if stage == 'batch':
+                        stage, remaining = 'parallel', [[i] for chunk in remaining for i in chunk]
+                        notify(None, "⚠️ 工作进程异常退出，剩余文件改为逐个文件并行转换")
+                        continue
+                    if stage == 'parallel':
+                        stage, suspects = 'serial', min(len(remaining), workers + 1)
+                        notify(None, f"⚠️ 工作进程再次异常退出，逐个转换最早提交的 {suspects} 个未完成文件以找出原因")
+                        continue
+                    index = remaining[0][0]
+                    strikes[index] += 1
+                    if strikes[index] >= 2:
+                        remaining.pop(0)
+                        suspects -= 1
+                        if suspects <= 0: stage = 'parallel'
+                        yield [index], [_failed_result(files_to_convert[index], source_dir, "工作进程异常退出（可能超出内存上限）", StageTimer())]
+            finally:
+                for future in pool_futures: future.cancel()
+
+        convert_started, converted_cost = time.perf_counter(), 0
+        def advance(i):
+            """文件i完成后按已完成的开销计算进度，并按目前为止的平均速度估算剩余秒数"""
+            nonlocal converted_cost
+            converted_cost += costs[i]
+            eta = round((time.perf_counter() - convert_started) * (pending_cost - converted_cost) / converted_cost)
+            return 10 + int((total_cost - pending_cost + converted_cost) / total_cost * 80), eta
+
+        futures = {}
+        if mode == 'word' and workers > 1 and len(chunks) > 1:
+            # Word转换的耗时都在子进程中，用线程并行即可
+            pool = get_word_executor() if jobs is None else ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='word')
+            if jobs is not None: own_pool = pool
+            futures = {pool.submit(convert_file_batch, [files_to_convert[i] for i in chunk], source_dir, output_dir, mode, style_options): chunk for chunk in chunks}
+            notify(10, f"已将 {len(to_convert)} 个文件分发到 {workers} 个xelatex作业并行转换")
+            completed = ((futures[future], future.result()) for future in as_completed(futures))
+        elif mode == 'markdown' and (jobs is None or (workers > 1 and len(chunks) > 1)):
+            # Web服务中的排版总是在进程池中进行，超时或内存不足只影响工作进程，不会拖垮Flask进程
+            notify(10, f"已将 {len(to_convert)} 个文件分为 {len(chunks)} 批，分发到 {workers} 个工作进程转换")
+            completed = convert_in_pool()
+        else:
+            def convert_inline():
+                started_files = len(reused)
+                for chunk in chunks:
+                    first, last = started_files + 1, started_files + len(chunk)
+                    notify(None, f"({first}/{total_files}) 正在处理: {os.path.relpath(files_to_convert[chunk[0]], source_dir)}" if first == last else f"({first}-{last}/{total_files}) 正在处理 {len(chunk)} 个文件...")
+                    started_files = last
+                    yield chunk, convert_file_batch([files_to_convert[i] for i in chunk], source_dir, output_dir, mode, style_options)
+            completed = convert_inline()
+
+        results = [None] * total_files
+        done = 0
+        for i, result in reused.items():
+            results[i] = result
+            report.add(i, result)
+            if zipf: zipf.write(os.path.join(output_dir, result_pdf_relpath(files_to_convert[i], source_dir)), result_pdf_relpath(files_to_convert[i], source_dir))
+            done += 1
+        try:
+            for chunk, chunk_results in completed:
+                for i, result in zip(chunk, chunk_results):
+                    results[i] = result
+                    if checkpoint:
+                        checkpoint.write(json.dumps({'result': result, 'source': source_fingerprint(files_to_convert[i])}, ensure_ascii=False) + '\n')
+                        checkpoint.flush()
+                    file_timer = StageTimer()
+                    file_timer.merge(result['stages'])
+                    with file_timer.stage('report'): report.add(i, result)
+                    done += 1
+                    progress, eta = advance(i)
+                    if result['error']:
+                        timings.merge(file_timer.seconds)
+                        METRICS.inc('md2pdf_file_failures_total', mode=mode)
+                        notify(progress, f"({done}/{total_files}) ❌ 转换失败: {result['path']}: {result['error']}", eta)
+                        continue
+                    pdf_relpath = result_pdf_relpath(files_to_convert[i], source_dir)
+                    if zipf:
+                        with file_timer.stage('zip'): zipf.write(os.path.join(output_dir, pdf_relpath), pdf_relpath)
+                    timings.merge(file_timer.seconds)
+                    METRICS.observe_stages(file_timer)
+                    METRICS.inc('md2pdf_files_total', mode=mode, cache='hit' if result['cache_hit'] else 'miss')
+                    if isinstance(result['row']['页数'], int): METRICS.inc('md2pdf_pages_total', result['row']['页数'])
+                    METRICS.inc('md2pdf_output_bytes_total', result['bytes'])
+                    cache_note = "（命中渲染缓存）" if result['cache_hit'] else ""
+                    notify(progress, f"({done}/{total_files}) 已完成: {result['path']}{cache_note}", eta)
+        except Exception:
+            completed.close()
+            for future in futures: future.cancel()
+            raise
+
+        failures = [result for result in results if result['error']]
+        if len(failures) == total_files:
+            raise RuntimeError(f"全部 {total_files} 个文件转换失败，如 {failures[0]['path']}: {failures[0]['error']}")
+        if failures: notify(None, f"⚠️ {len(failures)} 个文件转换失败，原因已记录在汇总报告的“状态”列中")
+        converted = [file_path for file_path, result in zip(files_to_convert, results) if not result['error']]
+
+        cache_hits = sum(1 for i in to_convert if results[i]['cache_hit'])
+        notify(92, f"渲染缓存: 命中 {cache_hits} 个, 未命中 {len(to_convert) - len(failures) - cache_hits} 个")
+        prune_render_cache()
+
+        merged_path = None
+        if merge_pdf:
+            notify(93, f"正在将 {len(converted)} 个PDF合并为单个文件...")
+            merged_name = f"合并结果_{name or pathlib.Path(os.path.abspath(source_dir)).name}.pdf"
+            merged_path = os.path.join(output_dir, merged_name)
+            with task_timer.stage('merge'):
+                merged_pages = merge_result_pdfs(converted, source_dir, output_dir, merged_path)
+                if zipf: zipf.write(merged_path, merged_name)
+            notify(None, f"合并完成: {merged_name}，共 {merged_pages} 页")
+
+        notify(95, "写入汇总报告...")
+        with task_timer.stage('report'): report.close()
+        if zipf:
+            with task_timer.stage('zip'):
+                zipf.write(report_path, REPORT_CSV_NAME, compress_type=zipfile.ZIP_DEFLATED)
+                if jsonl_path: zipf.write(jsonl_path, REPORT_JSONL_NAME, compress_type=zipfile.ZIP_DEFLATED)
+                notify(98, "完成压缩包...")
+                zipf.close()
+                os.replace(zip_path + '.part', zip_path)
+    except Exception:
+        if report: report.close()
+        if zipf:
+            zipf.close()
+            if os.path.exists(zipf.filename): os.remove(zipf.filename)
+        raise
+    finally:
+        if own_pool: own_pool.shutdown(cancel_futures=True)
+        if checkpoint: checkpoint.close()
+
+    METRICS.observe_stages(task_timer)
+    for name, seconds in task_timer.seconds.items(): timings.add(name, seconds)
+    details = [result_detail(result) for result in results]
+    return {'source_dir': source_dir, 'output_dir': output_dir, 'mode': mode, 'files': total_files, 'failed': len(failures), 'reused': len(reused), 'cache_hits': cache_hits,
+            'pages': sum(d['pages'] for d in details if isinstance(d['pages'], int)), 'bytes': sum(d['bytes'] for d in details),
+            'seconds': round(time.perf_counter() - started, 3), 'report': report_path, 'report_jsonl': jsonl_path,
+            'merged_pdf': merged_path, 'zip': zip_path, 'timings': timings.summary(), 'results': details}
+
+def run_conversion_thread(task_id, style_options=None, merge_pdf=False):
+    task_info = TASK_STORE.get(task_id)
+    if not task_info: return
+    task_dir, mode = task_info['task_dir'], task_info['mode']
+
     print(f"\n[TASK {task_id}] ==> 开始执行转换线程...")
+    # timings 只统计本次转换，重新转换或续转时不与上一次的耗时累加
+    TASK_STORE.update(task_id, {'failed_files': None, 'timings': None})
+    update_task_status(task_id, 'PROGRESS', progress=5, log="已获得转换槽位，开始扫描文件...")
+    checkpoint_path = os.path.join(task_dir, CHECKPOINT_NAME)
     try:
         source_dir, result_dir = os.path.join(task_dir, 'source'), os.path.join(task_dir, 'result')
-        file_extensions = ('.docx', '.doc') if mode == 'word' else ('.md',)
-        print(f"[TASK {task_id}] 扫描源目录 {source_dir}，查找 {file_extensions} 文件...")
-        
-        all_files_found = []
-        for dp, dn, fn in os.walk(source_dir):
-            if '__MACOSX' in dp.split(os.sep): continue
-            for f in fn:
-                if f.startswith('._'): continue
-                if f.lower().endswith(file_extensions): all_files_found.append(os.path.join(dp, f))
-        
-        if not all_files_found: raise ValueError(f"未找到有效的 {file_extensions} 文件。")
-        
-        print(f"[TASK {task_id}] 共找到 {len(all_files_found)} 个有效文件待转换。")
-        files_to_convert, report_results, total_files = sorted(list(set(all_files_found))), [], len(all_files_found)
-        custom_css = weasyprint.CSS(string=get_css_style(style_options)) if mode == 'markdown' else None
-        if mode == 'markdown': print(f"[TASK {task_id}] 已生成自定义CSS样式。")
-
-        for i, file_path in enumerate(files_to_convert):
-            filename = os.path.relpath(file_path, source_dir)
-            progress = 10 + int((i / total_files) * 80)
-            update_task_status(task_id, 'PROGRESS', progress=progress, log=f"({i+1}/{total_files}) 正在处理: {filename}")
-            print(f"[TASK {task_id}] ({i+1}/{total_files}) 正在处理: {filename}")
-            
-            rel_path = os.path.relpath(file_path, source_dir)
-            pdf_path = os.path.join(result_dir, os.path.splitext(rel_path)[0] + '.pdf')
-            os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
-
-            if mode == 'markdown':
-                md_content = read_file_with_fallback(file_path)
-                processed_md = preprocess_markdown_images(md_content, os.path.dirname(file_path))
-                html_body = pypandoc.convert_text(source=processed_md, to='html', format='markdown+latex_macros', extra_args=[f'--highlight-style={style_options.get("code_theme", "kate")}'])
-                full_html = f'<!DOCTYPE html><html><head><meta charset="UTF-8"></head><body><article class="markdown-body">{html_body}</article></body></html>'
-                weasyprint.HTML(string=full_html).write_pdf(pdf_path, stylesheets=[custom_css])
-            else:
-                pypandoc.convert_file(file_path, 'pdf', outputfile=pdf_path, extra_args=['--pdf-engine=xelatex', '-V', 'mainfont=Microsoft YaHei'])
-
-            page_count = get_pdf_page_count(pdf_path)
-            category = pathlib.Path(rel_path).parts[0] if len(pathlib.Path(rel_path).parts) > 1 else '根目录'
-            report_results.append({"大目录": category, "文件名": pathlib.Path(file_path).stem, "页数": page_count})
-            print(f"      [LOG] 文件 {filename} 处理完成，共 {page_count} 页。")
-
-        if report_results:
-            update_task_status(task_id, 'PROGRESS', progress=95, log="生成汇总报告...")
-            pd.DataFrame(report_results).to_csv(os.path.join(result_dir, "转换结果汇总.csv"), index=False, encoding='utf_8_sig')
-
-        update_task_status(task_id, 'PROGRESS', progress=98, log="压缩结果...")
-        zip_filename = f"转换结果_{task_id[:8]}.zip"
-        zip_path = os.path.join(task_dir, zip_filename)
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(result_dir):
-                for file in files:
-                    zipf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), result_dir))
-        
-        print(f"[TASK {task_id}] ==> 转换线程成功完成。")
-        update_task_status(task_id, 'SUCCESS', progress=100, log="🎉 任务成功！可以下载文件了。", result_url=f"/download/{task_id}")
+        zip_path = os.path.join(task_dir, f"转换结果_{task_id[:8]}.zip")
+        summary = convert_directory(source_dir, result_dir, mode, style_options, merge_pdf=merge_pdf, zip_path=zip_path, name=task_id[:8],
+                                    on_progress=lambda progress, log, eta: update_task_status(task_id, 'PROGRESS', progress=progress, log=log, eta_seconds=eta), checkpoint_path=checkpoint_path)
+        add_task_timings(task_id, summary['timings'])
+        failed_files = [{'path': d['path'], 'error': d['error']} for d in summary['results'] if d['error']]
+        TASK_STORE.update(task_id, {'failed_files': failed_files})
+        finish_checkpoint(checkpoint_path, 'SUCCESS')
+        # 有文件失败时保留源文件和已生成的PDF，以便修正后续转
+        if DELETE_SOURCE_AFTER_CONVERSION and not failed_files: release_task_sources(task_id, task_dir)
+
+        print(f"[TASK {task_id}] ==> 转换线程成功完成{f'，{len(failed_files)} 个文件失败' if failed_files else ''}。")
+        METRICS.inc('md2pdf_tasks_total', state='success')
+        log = f"✅ 任务完成，其中 {len(failed_files)} 个文件转换失败，详见汇总报告。可以下载文件了。" if failed_files else "🎉 任务成功！可以下载文件了。"
+        update_task_status(task_id, 'SUCCESS', progress=100, log=log, result_url=f"/download/{task_id}")
 
     except Exception as e:
         print(f"[TASK {task_id}] 错误: 转换线程中发生异常！")
         traceback.print_exc()
+        METRICS.inc('md2pdf_tasks_total', state='failure')
+        finish_checkpoint(checkpoint_path, 'FAILURE')
         update_task_status(task_id, 'FAILURE', error=str(e))
 
+# ==============================================================================
+# 输出目录清理: 后台线程按保留时间和容量上限删除旧任务
+# ==============================================================================
+
+def directory_size(path):
+    total = 0
+    for dp, dn, fn in os.walk(path):
+        for f in fn:
+            try: total += os.lstat(os.path.join(dp, f)).st_size
+            except OSError: pass
+    return total
+
+def remove_path(path):
+    """删除文件或目录，返回释放的字节数"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            size = directory_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            size = os.lstat(path).st_size
+            os.remove(path)
+    except FileNotFoundError: return 0
+    return size
+
+def record_janitor_stats(**counts):
+    with JANITOR_LOCK:
+        for key, value in counts.items(): JANITOR_STATS[key] += value
+
+def release_task_sources(task_id, task_dir):
+    """转换成功后删除上传的ZIP和源文件。result目录也一并删除: 结果压缩包（不压缩存储）已包含逐个文件的PDF和合并PDF，
+    下载只提供压缩包，保留result目录只会让结果占用双倍磁盘空间；调用时压缩包必须已经写完"""
+    freed = sum(remove_path(os.path.join(task_dir, name)) for name in ('source.zip', 'source', 'result'))
+    record_janitor_stats(sources_released=1, bytes_reclaimed=freed)
+    TASK_STORE.update(task_id, {'source_released': True}, [{'log': f"已清理源文件，释放 {freed / 1024 / 1024:.1f} MB", 'is_diag': False}])
+    return freed
+
+def evict_task(task_id, task_dir):
+    """删除任务记录和任务目录；先删除记录，使并发的请求看到“无效的任务ID”而不是半删除的目录"""
+    TASK_STORE.delete(task_id)
+    if not task_dir or not is_path_within(task_dir, OUTPUT_DIR) or os.path.abspath(task_dir) == os.path.abspath(OUTPUT_DIR): return 0
+    return remove_path(task_dir)
+
+def mark_stale_task(task_id, stale_before):
+    """把长时间未更新的进行中任务标记为失败；比较并设置，期间任务有更新时不修改"""
+    error = f"任务超过 {TASK_STALE_HOURS:g} 小时没有进展（服务可能在处理过程中退出），请重新上传或续转"
+    return TASK_STORE.modify(task_id, lambda task: {'state': 'FAILURE', 'error': error, 'eta_seconds': None}
+                             if task and task.get('state') in ACTIVE_TASK_STATES and task.get('updated_at', 0) < stale_before else None,
+                             [{'log': f"❌ 任务失败: {error}", 'is_diag': False}])
+
+def run_janitor():
+    """执行一轮清理: 长时间无进展的任务 -> 过期任务 -> 无主目录 -> 容量上限；进行中的任务（上传、排队、转换）不会被清理"""
+    now = time.time()
+    expired = over_quota = orphans = stale = reclaimed = 0
+    evictable, owned_dirs = [], set()
+    for task_id in TASK_STORE.task_ids():
+        task = TASK_STORE.get(task_id)
+        if not task: continue
+        task_dir = os.path.abspath(task['task_dir']) if task.get('task_dir') else None
+        ttl = TASK_TTL_HOURS.get(task.get('state'))
+        if ttl is None:
+            if task_dir: owned_dirs.add(task_dir)
+            # 排队中和转换中的任务由所在进程定期续租，正常情况下不会超时
+            if task.get('state') in ACTIVE_TASK_STATES and TASK_STALE_HOURS > 0 and mark_stale_task(task_id, now - TASK_STALE_HOURS * 3600):
+                stale += 1
+            continue
+        if ttl > 0 and now - task.get('updated_at', now) > ttl * 3600:
+            reclaimed += evict_task(task_id, task_dir)
+            expired += 1
+            continue
+        if task_dir: owned_dirs.add(task_dir)
+        evictable.append((task.get('updated_at', now), task_id, task_dir))
+
+    # 任务目录之外的内容（_cache、tasks.db）不参与清理，渲染缓存有自己的容量上限
+    dir_sizes = {}
+    orphan_ttl = max(TASK_TTL_HOURS.values())
+    for entry in os.scandir(OUTPUT_DIR):
+        if entry.name.startswith('_') or not entry.is_dir(follow_symlinks=False): continue
+        path = os.path.abspath(entry.path)
+        if path not in owned_dirs:
+            # 没有对应任务记录的目录（如使用memory存储时重启前留下的目录），超过最长保留时间后删除
+            if orphan_ttl > 0 and now - entry.stat(follow_symlinks=False).st_mtime > orphan_ttl * 3600:
+                reclaimed += remove_path(path)
+                orphans += 1
+            continue
+        dir_sizes[path] = directory_size(path)
+
+    usage = sum(dir_sizes.values())
+    if OUTPUT_QUOTA_BYTES and usage > OUTPUT_QUOTA_BYTES:
+        for updated_at, task_id, task_dir in sorted(evictable, key=lambda item: item[0]):
+            if usage <= OUTPUT_QUOTA_BYTES: break
+            freed = evict_task(task_id, task_dir)
+            usage -= dir_sizes.get(task_dir, freed)
+            reclaimed += freed
+            over_quota += 1
+
+    with JANITOR_LOCK:
+        JANITOR_STATS['runs'] += 1
+        JANITOR_STATS['last_run'] = datetime.datetime.now().isoformat(timespec='seconds')
+        JANITOR_STATS['output_bytes'] = usage
+    record_janitor_stats(tasks_expired=expired, tasks_over_quota=over_quota, tasks_stale=stale, orphans_removed=orphans, bytes_reclaimed=reclaimed)
+    if expired or over_quota or orphans or stale:
+        print(f"[JANITOR] 清理过期任务 {expired} 个，超出容量淘汰 {over_quota} 个，无主目录 {orphans} 个，标记无进展任务 {stale} 个，释放 {reclaimed / 1024 / 1024:.1f} MB")
+
+def janitor_loop():
+    while True:
+        try: run_janitor()
+        except Exception:
+            print("[JANITOR] 错误: 清理输出目录时发生异常！")
+            traceback.print_exc()
+        # 同时恢复其他进程退出时留下的中断任务（启动时的首次恢复由 start_recovery 执行）
+        if RESUME_ON_START and RECOVERY_STARTED:
+            try: recover_unfinished_tasks()
+            except Exception:
+                print("[RECOVERY] 错误: 恢复中断的任务时发生异常！")
+                traceback.print_exc()
+        time.sleep(JANITOR_INTERVAL_SECONDS)
+
+def start_janitor():
+    global JANITOR_THREAD
+    with JANITOR_LOCK:
+        if JANITOR_THREAD is None:
+            JANITOR_THREAD = threading.Thread(target=janitor_loop, name='janitor', daemon=True)
+            JANITOR_THREAD.start()
+
+
+# ==============================================================================
+# 启动预热
+# ==============================================================================
+
+def warm_up_process():
+    """导入转换依赖，并用默认样式完整转换一个小文档，使Pandoc、WeasyPrint/cairo/pango的加载和字体发现在用户请求之前完成"""
+    import pypandoc
+    html_body = pypandoc.convert_text(source='# 预热 Warm-up\n\n中文 **English** `code`', to='html', format='markdown+latex_macros')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        make_weasyprint_html(html_body, tmp_dir, tmp_dir).write_pdf(stylesheets=[get_stylesheet(get_css_style({}))], font_config=get_font_config())
+
+def warm_up_worker():
+    """进程池初始化函数；预热失败不应导致整个进程池不可用，只记录错误"""
+    try: warm_up_process()
+    except Exception:
+        print(f"[WARMUP] 错误: 工作进程 {os.getpid()} 预热失败！")
+        traceback.print_exc()
+
+def run_warmup():
+    start = time.perf_counter()
+    try:
+        # Flask进程本身只调用Pandoc（预览），WeasyPrint排版都在进程池中，由各工作进程的初始化函数预热
+        import pypandoc
+        pypandoc.convert_text(source='# 预热 Warm-up', to='html', format='markdown+latex_macros')
+        if shutil.which('xelatex'):
+            # Word转换不是必需功能，xelatex预热失败只记录日志
+            try: warm_up_tex()
+            except Exception as e: print(f"[WARMUP] xelatex 预热失败: {e}")
+        # 提交的任务数等于进程数，进程池会一次启动全部工作进程，并在各自的初始化函数完成后才执行任务
+        for pool, workers in ((get_process_pool(), CONVERSION_WORKERS), (get_preview_pool(), PREVIEW_WORKERS)):
+            for future in [pool.submit(os.getpid) for _ in range(workers)]: future.result()
+        state, error = 'READY', None
+    except Exception as e:
+        traceback.print_exc()
+        state, error = 'FAILED', str(e)
+    seconds = round(time.perf_counter() - start, 2)
+    with WARMUP_LOCK:
+        WARMUP_STATE.update(state=state, error=error, seconds=seconds, finished_at=datetime.datetime.now().isoformat(timespec='seconds'),
+                            pool_workers=CONVERSION_WORKERS, preview_workers=PREVIEW_WORKERS)
+    print(f"[WARMUP] 预热{'完成' if state == 'READY' else '失败'}，耗时 {seconds}s" + (f": {error}" if error else ""))
+
+def start_warmup():
+    with WARMUP_LOCK:
+        if WARMUP_STATE['state'] != 'PENDING': return
+        WARMUP_STATE['started_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+        if not WARMUP_ON_START:
+            WARMUP_STATE.update(state='READY', finished_at=WARMUP_STATE['started_at'], seconds=0)
+            return
+        WARMUP_STATE['state'] = 'WARMING'
+    threading.Thread(target=run_warmup, name='warmup', daemon=True).start()
+
+
+# ==============================================================================
+# 任务调度器: 固定数量的工作线程 + 按客户端轮转的公平队列
+# ==============================================================================
+
+class JobScheduler:
+    """转换任务调度器。每个客户端有自己的FIFO队列，客户端之间轮流出队，避免单个用户占满所有工作线程"""
+    def __init__(self, workers, max_queued):
+        self.workers, self.max_queued = workers, max_queued
+        self.queues = collections.OrderedDict()  # client -> deque[(task_id, func, args)]
+        self.cond = threading.Condition()
+        self.running = 0
+        self.active = set()  # 本进程中排队中和转换中的任务
+        self.threads = []
+
+    def _ensure_workers(self):
+        # 工作线程延迟启动，避免进程池子进程导入本模块时也创建线程
+        if not self.threads:
+            threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True).start()
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self._worker_loop, name=f"job-worker-{len(self.threads)}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def _heartbeat_loop(self):
+        # 定期刷新本进程中排队中和转换中任务的更新时间，其他进程据此判断这些任务没有中断
+        while True:
+            time.sleep(TASK_LEASE_SECONDS / 3)
+            with self.cond: task_ids = list(self.active)
+            try: TASK_STORE.touch(task_ids)
+            except Exception: traceback.print_exc()
+
+    def submit(self, client, task_id, func, *args, claimable=None, before_queue=None):
+        """加入队列并返回排队位置；队列已满时返回None，任务已在排队或转换中时返回0。
+        入队前在任务存储中比较并设置状态为 QUEUED（claimable(任务记录) 为真才设置，默认要求任务不在进行中），
+        多个Web进程共享任务数据库时同一任务也只会被一个进程加入队列；before_queue 在设置成功后、任务可被取出前调用"""
+        claimable = claimable or (lambda task: task.get('state') not in ACTIVE_TASK_STATES)
+        with self.cond:
+            if task_id in self.active: return 0
+            if sum(len(q) for q in self.queues.values()) >= self.max_queued: return None
+            queue = self.queues.setdefault(client, collections.deque())
+            queue.append((task_id, func, args))
+            position = next(p for p, queued_id in enumerate(self._dispatch_order(), 1) if queued_id == task_id)
+            # 在持有调度锁时写入 QUEUED，保证工作线程取出任务后写入的 PROGRESS 不会被覆盖
+            claimed = TASK_STORE.modify(task_id, lambda task: {'state': 'QUEUED', 'progress': 0, 'eta_seconds': None} if task and claimable(task) else None,
+                                        [{'log': f"已加入转换队列，等待转换槽位（排队位置: {position}）", 'is_diag': False}])
+            if not claimed:
+                queue.pop()
+                if not queue: del self.queues[client]
+                return 0
+            if before_queue: before_queue()
+            self.active.add(task_id)
+            self._ensure_workers()
+            self.cond.notify()
+            return position
+
+    def _dispatch_order(self):
+        # 按轮转规则模拟出队顺序: 每轮每个客户端各出一个任务
+        queues = [list(q) for q in self.queues.values()]
+        for r in range(max((len(q) for q in queues), default=0)):
+            for q in queues:
+                if r < len(q): yield q[r][0]
+
+    def queue_position(self, task_id):
+        """返回任务在队列中的位置（从1开始），不在队列中时返回None"""
+        with self.cond:
+            for position, queued_id in enumerate(self._dispatch_order(), 1):
+                if queued_id == task_id: return position
+        return None
+
+    def stats(self):
+        """返回 (排队任务数, 运行中任务数)"""
+        with self.cond: return sum(len(q) for q in self.queues.values()), self.running
+
+    def _next_job(self):
+        client, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        del self.queues[client]
+        if queue: self.queues[client] = queue  # 该客户端还有任务则移到队尾
+        return job
+
+    def _worker_loop(self):
+        while True:
+            with self.cond:
+                while not self.queues: self.cond.wait()
+                task_id, func, args = self._next_job()
+                self.running += 1
+            print(f"[TASK {task_id}] ==> 已获得转换槽位，开始执行。")
+            try: func(task_id, *args)
+            except Exception: traceback.print_exc()
+            finally:
+                with self.cond:
+                    self.running -= 1
+                    self.active.discard(task_id)
+
+JOB_SCHEDULER = JobScheduler(MAX_CONCURRENT_JOBS, MAX_QUEUED_JOBS)
+
+def recover_unfinished_tasks():
+    """恢复排队中或转换中、但超过 TASK_LEASE_SECONDS 秒没有被所在进程刷新的任务: 检查点中没有最终状态的任务重新排队，
+    续转时跳过已完成的文件。认领是原子的，多个进程同时恢复时每个任务只会被一个进程重新排队。
+    使用memory存储时任务记录已丢失，根据任务目录和检查点重建"""
+    recovered, cutoff = 0, time.time() - TASK_LEASE_SECONDS
+    for entry in os.scandir(OUTPUT_DIR):
+        if entry.name.startswith('_') or not entry.is_dir(follow_symlinks=False): continue
+        task_id, checkpoint_path = entry.name, os.path.join(entry.path, CHECKPOINT_NAME)
+        settings, entries, state = read_checkpoint(checkpoint_path)
+        if settings is None or state or task_id in JOB_SCHEDULER.active: continue
+        task = TASK_STORE.get(task_id)
+        if task and (task.get('state') not in ('QUEUED', 'PROGRESS') or task.get('updated_at', 0) >= cutoff): continue
+        # 任务记录不存在时只有创建了记录的进程可以恢复该任务
+        created = not task and TASK_STORE.modify(task_id, lambda t: None if t else {'task_dir': entry.path, 'mode': settings['mode'], 'state': 'QUEUED'})
+        if not task and not created: continue
+        def claimable(t): return t.get('state') in ('QUEUED', 'PROGRESS') and (created or t.get('updated_at', 0) < cutoff)
+        if not os.path.isdir(os.path.join(entry.path, 'source')):
+            error = "服务重启时任务中断，且源文件已不存在，请重新上传"
+            if TASK_STORE.modify(task_id, lambda t: {'state': 'FAILURE', 'error': error, 'eta_seconds': None} if t and claimable(t) else None,
+                                 [{'log': f"❌ 任务失败: {error}", 'is_diag': False}]):
+                finish_checkpoint(checkpoint_path, 'FAILURE')
+            continue
+        completed = sum(1 for item in entries.values() if not item['result']['error'])
+        position = JOB_SCHEDULER.submit('recovered', task_id, run_conversion_thread, settings['style_options'], settings['merge_pdf'], claimable=claimable,
+                                        before_queue=lambda: TASK_STORE.update(task_id, {}, [{'log': f"服务重启，恢复中断的任务（已完成 {completed} 个文件）", 'is_diag': False}]))
+        if position is None:
+            print(f"[RECOVERY] 转换队列已满，任务 {task_id} 留待下次恢复。")
+            continue
+        if position: recovered += 1
+    if recovered: print(f"[RECOVERY] 已恢复 {recovered} 个中断的转换任务。")
+
+def start_recovery():
+    global RECOVERY_STARTED
+    with RECOVERY_LOCK:
+        if RECOVERY_STARTED: return
+        RECOVERY_STARTED = True
+    if not RESUME_ON_START: return
+    try: recover_unfinished_tasks()
+    except Exception:
+        print("[RECOVERY] 错误: 恢复中断的任务时发生异常！")
+        traceback.print_exc()
+
+@app.before_request
+def ensure_background_services():
+    # 首个请求时启动清理线程和预热、恢复中断的任务，以 python app.py 或 WSGI 服务器方式运行时都会生效
+    if JANITOR_THREAD is None: start_janitor()
+    if WARMUP_STATE['state'] == 'PENDING': start_warmup()
+    if not RECOVERY_STARTED: start_recovery()
+
 @app.route('/')
 def index():
     return render_template_string(HTML_TEMPLATE)
@@ -782,66 +2696,149 @@ def prepare_upload():
     os.makedirs(source_dir, exist_ok=True)
     mode = request.form.get('mode', 'markdown')
     upload_type = request.form.get('upload_type')
-    with TASKS_LOCK: TASKS[task_id] = {'task_dir': task_dir, 'mode': mode, 'state': 'PREPARING'}
+    TASK_STORE.create(task_id, {'task_dir': task_dir, 'mode': mode, 'state': 'PREPARING'})
     print(f"[TASK {task_id}] 2. 模式: {mode}, 上传类型: {upload_type}")
     
     print(f"[TASK {task_id}] 3. 开始处理上传的文件...")
     if upload_type == 'folder':
         files = request.files.getlist("files[]")
         if not files: return jsonify({'error': '未选择任何文件夹内容'}), 400
-        print(f"      [LOG] 收到 {len(files)} 个文件。")
+        saved, skipped = 0, 0
+        timer = StageTimer()
         for file in files:
             relative_path = file.filename or ""
             if not relative_path: continue
             normalized_path = os.path.normpath(relative_path)
-            if ".." in normalized_path.split(os.sep): continue
             destination_path = os.path.join(source_dir, normalized_path)
-            if not os.path.abspath(destination_path).startswith(os.path.abspath(source_dir)): continue
+            if ".." in normalized_path.split(os.sep) or not is_path_within(destination_path, source_dir):
+                skipped += 1
+                continue
             os.makedirs(os.path.dirname(destination_path), exist_ok=True)
-            print(f"      [LOG] 正在保存: {relative_path} -> {destination_path}")
-            file.save(destination_path)
-    else: # zip
-        file = request.files.get('zipfile')
-        if not file or not file.filename.endswith('.zip'): return jsonify({'error': '请上传一个ZIP文件'}), 400
-        zip_path = os.path.join(task_dir, 'source.zip')
-        print(f"      [LOG] 正在保存ZIP文件到: {zip_path}")
-        file.save(zip_path)
-        unzip_with_encoding_fix(zip_path, source_dir)
-    
-    print(f"[TASK {task_id}] 4. 文件保存/解压完成，开始查找可预览的文件...")
-    preview_files = []
-    if mode == 'markdown':
-        for dp, _, fn in os.walk(source_dir):
-            if '__MACOSX' in dp.split(os.sep): continue
-            for f in sorted(fn):
-                if f.startswith('._'): continue
-                if f.lower().endswith('.md'):
-                    preview_files.append(os.path.relpath(os.path.join(dp, f), source_dir))
-    
-    if preview_files: print(f"      [LOG] 找到 {len(preview_files)} 个可预览文件。")
-    else: print(f"      [LOG] 未找到可用的预览文件。")
-
-    update_task_status(task_id, 'READY', preview_files=preview_files)
-    response_data = {'task_id': task_id, 'preview_files': preview_files}
-    
-    print(f"[TASK {task_id}] 5. 准备阶段完成，返回给前端。")
-    return jsonify(response_data)
-
+            with timer.stage('upload_save'): file.save(destination_path)
+            saved += 1
+        print(f"      [LOG] 收到 {len(files)} 个文件，已保存 {saved} 个，跳过非法路径 {skipped} 个。")
+        METRICS.observe_stages(timer)
+        add_task_timings(task_id, {'upload_save': {'seconds': timer.seconds['upload_save'], 'count': 1}})
+        preview_files = finish_upload_preparation(task_id, source_dir, mode)
+        print(f"[TASK {task_id}] 5. 准备阶段完成，返回给前端。")
+        return jsonify({'task_id': task_id, 'state': 'READY', 'preview_files': preview_files})
+
+    file = request.files.get('zipfile')
+    if not file or not file.filename.endswith('.zip'): return jsonify({'error': '请上传一个ZIP文件'}), 400
+    zip_path = os.path.join(task_dir, 'source.zip')
+    print(f"      [LOG] 正在保存ZIP文件到: {zip_path}")
+    timer = StageTimer()
+    with timer.stage('upload_save'): file.save(zip_path)
+    METRICS.observe_stages(timer)
+    add_task_timings(task_id, timer.summary())
+    # 解压可能涉及上万个文件，放到后台进行，前端通过 /status 查看解压进度并获取可预览文件列表
+    update_task_status(task_id, 'EXTRACTING', progress=0, log="正在后台解压上传的ZIP文件...")
+    INGEST_EXECUTOR.submit(extract_upload_thread, task_id, zip_path, source_dir, mode)
+    print(f"[TASK {task_id}] 4. ZIP文件已保存，后台解压中，返回给前端。")
+    return jsonify({'task_id': task_id, 'state': 'EXTRACTING', 'preview_files': []})
+
+
+def conversion_conflict(task):
+    """任务当前不能开始（或续转）转换时返回错误响应，否则返回None"""
+    if not task: return jsonify({'error': '无效的任务ID'}), 404
+    state = task.get('state')
+    if state in ('PREPARING', 'EXTRACTING'): return jsonify({'error': '上传的文件仍在处理中，请稍后再试'}), 409
+    if state in ('QUEUED', 'PROGRESS'): return jsonify({'error': '该任务已在队列中或正在转换'}), 409
+    if task.get('source_released'): return jsonify({'error': '该任务的源文件已清理，请重新上传'}), 410
+    return None
+
+def enqueue_conversion(client, task_id, task, style_options, merge_pdf):
+    """加入调度队列，并在任务可被取出前把转换设置写入检查点（服务在任务排队期间重启也能恢复）。
+    返回排队位置，队列已满时返回None，任务已被其他请求加入队列时返回0"""
+    checkpoint_path = os.path.join(task['task_dir'], CHECKPOINT_NAME)
+    position = JOB_SCHEDULER.submit(client, task_id, run_conversion_thread, style_options, merge_pdf,
+                                    before_queue=lambda: reset_checkpoint(checkpoint_path, checkpoint_settings(task['mode'], style_options, merge_pdf)))
+    if position is None: print(f"[TASK {task_id}] 转换队列已满，拒绝请求。")
+    return position
 
 @app.route('/start_conversion', methods=['POST'])
 def start_conversion():
     data = request.get_json()
     task_id, style_options = data.get('task_id'), data.get('style_options', {})
+    merge_pdf = bool(data.get('merge_pdf'))
     print(f"\n[TASK {task_id}] ==> 收到开始转换信号。")
-    if not task_id or task_id not in TASKS: return jsonify({'error': '无效的任务ID'}), 404
-    update_task_status(task_id, 'QUEUED', progress=0, log="已加入转换队列")
-    threading.Thread(target=run_conversion_thread, args=(task_id, style_options)).start()
-    return jsonify({'task_id': task_id, 'message': '转换已开始'})
+    task = TASK_STORE.get(task_id) if task_id else None
+    conflict = conversion_conflict(task)
+    if conflict: return conflict
+    cursor = current_log_cursor(task_id)
+    position = enqueue_conversion(request.remote_addr, task_id, task, style_options, merge_pdf)
+    if position is None: return jsonify({'error': '转换队列已满，请稍后重试'}), 429, {'Retry-After': '30'}
+    if not position: return jsonify({'error': '该任务已在队列中或正在转换'}), 409
+    return jsonify({'task_id': task_id, 'message': '转换已开始', 'queue_position': position, 'cursor': cursor})
+
+@app.route('/resume_conversion', methods=['POST'])
+def resume_conversion():
+    """续转: 沿用上次的转换设置，只重新转换失败、缺失或源文件已变化的文件"""
+    task_id = (request.get_json() or {}).get('task_id')
+    print(f"\n[TASK {task_id}] ==> 收到续转信号。")
+    task = TASK_STORE.get(task_id) if task_id else None
+    conflict = conversion_conflict(task)
+    if conflict: return conflict
+    settings, entries, _ = read_checkpoint(os.path.join(task['task_dir'], CHECKPOINT_NAME))
+    if settings is None: return jsonify({'error': '该任务尚未开始过转换，无法续转'}), 409
+    cursor = current_log_cursor(task_id)
+    position = enqueue_conversion(request.remote_addr, task_id, task, settings['style_options'], settings['merge_pdf'])
+    if position is None: return jsonify({'error': '转换队列已满，请稍后重试'}), 429, {'Retry-After': '30'}
+    if not position: return jsonify({'error': '该任务已在队列中或正在转换'}), 409
+    completed = sum(1 for entry in entries.values() if not entry['result']['error'])
+    return jsonify({'task_id': task_id, 'message': '续转已开始', 'queue_position': position, 'completed_files': completed, 'cursor': cursor})
+
+class LRUCache:
+    """线程安全的LRU缓存，按条目大小（默认为值的长度）限制总容量"""
+    def __init__(self, max_size):
+        self.max_size, self.size = max_size, 0
+        self.data = collections.OrderedDict()  # key -> (value, size)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None: return None
+            self.data.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        if size is None: size = len(value)
+        if size > self.max_size: return
+        with self.lock:
+            old = self.data.pop(key, None)
+            if old is not None: self.size -= old[1]
+            self.data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.data.popitem(last=False)
+                self.size -= evicted_size
+
+PREVIEW_CACHE = LRUCache(PREVIEW_CACHE_MAX_BYTES)
+
+def render_preview(html_body, css_text, preview_pages, md_file_dir, root_dir):
+    """在预览进程池中执行: 排版预览PDF，返回PDF字节和是否被截断；preview_pages为0时排版整个文档"""
+    with render_deadline(RENDER_TIMEOUT_SECONDS):
+        css = get_stylesheet(css_text)
+        if preview_pages: return render_first_pages(html_body, css, preview_pages, md_file_dir, root_dir)
+        return make_weasyprint_html(html_body, md_file_dir, root_dir).write_pdf(stylesheets=[css], font_config=get_font_config()), False
+
+def render_first_pages(html_body, css, max_pages, md_file_dir, root_dir):
+    """只排版文档开头的部分，返回前max_pages页的PDF字节和是否被截断"""
+    # Pandoc输出的顶层块元素都从新行开始，只在这些位置截断，避免切开标签
+    boundaries = [m.start() for m in re.finditer(r'\n(?=<(?:h[1-6]|p|pre|table|div|ul|ol|dl|blockquote|figure|hr)[\s>/])', html_body)] + [len(html_body)]
+    budget = max_pages * PREVIEW_CHARS_PER_PAGE
+    while True:
+        cut = next((b for b in boundaries if b >= budget), len(html_body))
+        document = make_weasyprint_html(html_body[:cut], md_file_dir, root_dir).render(stylesheets=[css], font_config=get_font_config())
+        if len(document.pages) >= max_pages or cut == len(html_body): break
+        budget *= 2
+    truncated = cut < len(html_body) or len(document.pages) > max_pages
+    return document.copy(document.pages[:max_pages]).write_pdf(), truncated
 
 @app.route('/preview', methods=['POST'])
 def preview_pdf():
     import pypandoc
-    import weasyprint
 
     data = request.get_json()
     task_id, style_options = data.get('task_id'), data.get('style_options', {})
@@ -850,11 +2847,14 @@ def preview_pdf():
     
     try:
         if not preview_file_rel: raise ValueError("请求中未指定要预览的文件名。")
+        # 可选参数 preview_pages: 只渲染前N页，缺省时渲染整个文档
+        preview_pages = int(data.get('preview_pages') or 0)
+        if preview_pages < 0: raise ValueError("preview_pages 不能为负数。")
 
-        with TASKS_LOCK:
-            task = TASKS.get(task_id, {})
-            task_dir = task.get('task_dir')
+        task = TASK_STORE.get(task_id) or {}
+        task_dir = task.get('task_dir')
         if not task_dir: return Response("任务无效", status=404, mimetype='text/plain')
+        if task.get('source_released'): return Response("该任务的源文件已清理，请重新上传", status=410, mimetype='text/plain')
 
         source_dir = os.path.join(task_dir, 'source')
         preview_file_abs = os.path.join(source_dir, os.path.normpath(preview_file_rel))
@@ -863,16 +2863,46 @@ def preview_pdf():
             print(f"[TASK {task_id}] 严重错误: 检测到路径穿越尝试！请求文件: {preview_file_rel}")
             return Response("非法的预览文件请求", status=403, mimetype='text/plain')
 
+        # 缓存键包含文件的修改时间和大小，文件变化后旧条目自然失效
+        stat = os.stat(preview_file_abs)
+        file_key = (preview_file_abs, stat.st_mtime_ns, stat.st_size)
+        css_text, code_theme = get_css_style(style_options), style_options.get("code_theme", "kate")
+        max_image_width = image_max_width_px(style_options)
+        pdf_key = ('pdf', task_id, file_key, code_theme, css_text, max_image_width, preview_pages)
+        cached = PREVIEW_CACHE.get(pdf_key)
+        if cached is not None:
+            print(f"[TASK {task_id}] ==> 预览命中缓存，直接返回。")
+            return Response(cached[0], mimetype='application/pdf', headers={'X-Preview-Cache': 'hit', 'X-Preview-Truncated': '1' if cached[1] else '0'})
+
         print(f"[TASK {task_id}] 正在为文件生成预览: {preview_file_abs}")
-        md_content = read_file_with_fallback(preview_file_abs)
-
-        processed_md = preprocess_markdown_images(md_content, os.path.dirname(preview_file_abs))
-        html_body = pypandoc.convert_text(source=processed_md, to='html', format='markdown+latex_macros', extra_args=[f'--highlight-style={style_options.get("code_theme", "kate")}'])
-        full_html = f'<!DOCTYPE html><html><head><meta charset="UTF-8"></head><body><article class="markdown-body">{html_body}</article></body></html>'
-        css = weasyprint.CSS(string=get_css_style(style_options))
-        pdf_bytes = weasyprint.HTML(string=full_html).write_pdf(stylesheets=[css])
-        print(f"[TASK {task_id}] ==> 预览生成成功。")
-        return Response(pdf_bytes, mimetype='application/pdf')
+        # 仅样式变化时复用 Pandoc 输出，直接进入 WeasyPrint 排版
+        html_key = ('html', task_id, file_key, code_theme, max_image_width)
+        html_body = PREVIEW_CACHE.get(html_key)
+        if html_body is None:
+            md_key = ('md', file_key, max_image_width)
+            processed_md = PREVIEW_CACHE.get(md_key)
+            if processed_md is None:
+                _, md_content, _ = read_markdown_file(preview_file_abs)
+                processed_md = preprocess_markdown_images(md_content, os.path.dirname(preview_file_abs), source_dir, max_image_width)
+                PREVIEW_CACHE.put(md_key, processed_md)
+            html_body = pypandoc.convert_text(source=processed_md, to='html', format='markdown+latex_macros', extra_args=[f'--highlight-style={code_theme}'])
+            PREVIEW_CACHE.put(html_key, html_body)
+        else:
+            print(f"[TASK {task_id}] 复用缓存的Pandoc输出，仅重新排版。")
+        # 排版在预览进程中进行，超时、内存不足或进程崩溃都不会影响Flask进程和其他用户的预览
+        pool = get_preview_pool()
+        try:
+            pdf_bytes, truncated = result_with_deadline(pool, pool.submit(render_preview, html_body, css_text, preview_pages, os.path.dirname(preview_file_abs), source_dir), pool_deadline(1, ahead=1))
+        except BrokenProcessPool:
+            discard_broken_pool(pool)
+            return Response("预览生成失败: 排版进程异常退出（文件可能过大或超出内存上限）", status=500, mimetype='text/plain')
+        except TimeoutError as e:
+            return Response(f"预览生成失败: {e}", status=504, mimetype='text/plain')
+        except MemoryError as e:
+            return Response(f"预览生成失败: {describe_error(e)}", status=500, mimetype='text/plain')
+        PREVIEW_CACHE.put(pdf_key, (pdf_bytes, truncated), size=len(pdf_bytes))
+        print(f"[TASK {task_id}] ==> 预览生成成功{'（仅前 ' + str(preview_pages) + ' 页）' if truncated else ''}。")
+        return Response(pdf_bytes, mimetype='application/pdf', headers={'X-Preview-Cache': 'miss', 'X-Preview-Truncated': '1' if truncated else '0'})
     except Exception as e:
         print(f"[TASK {task_id}] 错误：预览生成时发生异常！")
         traceback.print_exc()
@@ -880,18 +2910,123 @@ def preview_pdf():
 
 @app.route('/status/<task_id>')
 def task_status(task_id):
-    logs = get_and_clear_logs(task_id)
-    with TASKS_LOCK: task = TASKS.get(task_id, {})
-    return jsonify({'state': task.get('state', 'UNKNOWN'), 'progress': task.get('progress', 0), 'logs': logs, 'error': task.get('error'), 'result_url': task.get('result_url')})
+    # cursor: 客户端已读取的日志条数; version + wait: 长轮询，版本号未变化时最多等待wait秒
+    cursor = request.args.get('cursor', 0, type=int)
+    version = request.args.get('version', type=int)
+    wait = min(request.args.get('wait', 0, type=float), STATUS_WAIT_MAX_SECONDS)
+    if version is not None and wait > 0: wait_for_task_update(task_id, version, wait)
+    return jsonify(get_task_snapshot(task_id, cursor))
+
+@app.route('/events/<task_id>')
+def task_events(task_id):
+    """以Server-Sent Events推送任务进度，任务结束后关闭连接；断线重连时通过 Last-Event-ID 续传日志"""
+    if TASK_STORE.get(task_id) is None: return jsonify({'error': '无效的任务ID'}), 404
+    cursor = request.headers.get('Last-Event-ID', type=int)
+    if cursor is None: cursor = request.args.get('cursor', 0, type=int)
+
+    def generate(cursor):
+        version = None
+        while True:
+            if version is not None: wait_for_task_update(task_id, version, STATUS_WAIT_MAX_SECONDS)
+            snapshot = get_task_snapshot(task_id, cursor)
+            # 任务记录在推送过程中被清理时 wait 会立即返回，推送一次 UNKNOWN 状态后结束，不能继续循环
+            if snapshot['version'] == version and snapshot['state'] != 'UNKNOWN':
+                yield ": keepalive\n\n"
+                continue
+            version, cursor = snapshot['version'], snapshot['cursor']
+            yield f"id: {cursor}\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+            if snapshot['state'] in TERMINAL_STATES or snapshot['state'] == 'UNKNOWN': return
+
+    return Response(stream_with_context(generate(cursor)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/download/<task_id>')
 def download_result(task_id):
-    with TASKS_LOCK: task_info = TASKS.get(task_id)
+    task_info = TASK_STORE.get(task_id)
     if not task_info or task_info.get('state') != 'SUCCESS': return "任务未完成或未找到", 404
     task_dir = task_info.get('task_dir')
     zip_filename = f"转换结果_{task_id[:8]}.zip"
     return send_from_directory(task_dir, zip_filename, as_attachment=True)
 
+@app.route('/ready')
+def readiness():
+    """就绪检查: 预热完成后返回200，预热中或预热失败时返回503，负载均衡器只应把流量转发给就绪的实例"""
+    with WARMUP_LOCK: state = dict(WARMUP_STATE)
+    return jsonify(state), 200 if state['state'] == 'READY' else 503
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus文本格式的监控指标"""
+    queued, running = JOB_SCHEDULER.stats()
+    with JANITOR_LOCK: reclaimed = JANITOR_STATS['bytes_reclaimed']
+    gauges = [('md2pdf_queue_depth', {}, queued), ('md2pdf_running_jobs', {}, running),
+              ('md2pdf_conversion_workers_configured', {}, CONVERSION_WORKERS), ('md2pdf_preview_cache_bytes', {}, PREVIEW_CACHE.size),
+              ('md2pdf_janitor_reclaimed_bytes_total', {}, reclaimed)]
+    return Response(METRICS.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/janitor/stats')
+def janitor_stats():
+    """输出目录清理统计（当前进程自启动以来的累计值）"""
+    with JANITOR_LOCK: stats = dict(JANITOR_STATS)
+    stats.update(ttl_hours=TASK_TTL_HOURS, quota_bytes=OUTPUT_QUOTA_BYTES, interval_seconds=JANITOR_INTERVAL_SECONDS)
+    return jsonify(stats)
+
+# ==============================================================================
+# 命令行入口: python app.py convert SRC OUT
+# ==============================================================================
+
+def cli_convert(argv):
+    """不启动Web服务，直接转换一个目录；任一文件失败时返回非零退出码"""
+    import argparse
+    parser = argparse.ArgumentParser(prog='python app.py convert', description='将目录中的Markdown/Word文件批量转换为PDF')
+    parser.add_argument('source', help='源目录')
+    parser.add_argument('output', help='输出目录，PDF按源目录结构写入，并生成汇总报告')
+    parser.add_argument('--mode', choices=('markdown', 'word'), default='markdown')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='并行转换的工作进程数（默认1）')
+    parser.add_argument('--style', action='append', default=[], metavar='KEY=VALUE', help='样式选项，与网页中的样式设置相同，如 font_size=14pt，可重复')
+    parser.add_argument('--style-file', help='JSON格式的样式选项文件')
+    parser.add_argument('--merge', action='store_true', help='同时生成合并后的单个PDF')
+    parser.add_argument('--zip', help='同时把结果写入该ZIP文件')
+    parser.add_argument('--json', metavar='PATH', help='以JSON输出转换摘要和每个文件的耗时，- 表示标准输出')
+    args = parser.parse_args(argv)
+
+    style_options = {}
+    if args.style_file:
+        with open(args.style_file, encoding='utf-8') as f: style_options.update(json.load(f))
+    for item in args.style:
+        key, sep, value = item.partition('=')
+        if not sep: parser.error(f"--style 参数格式应为 KEY=VALUE: {item}")
+        style_options[key.strip()] = value.strip()
+    if not os.path.isdir(args.source): parser.error(f"源目录不存在: {args.source}")
+
+    def on_progress(progress, log, eta):
+        if log: print(log, file=sys.stderr)
+
+    # --json - 时标准输出只保留JSON结果，其余日志写到stderr
+    log_stream = sys.stderr if args.json == '-' else sys.stdout
+    try:
+        with contextlib.redirect_stdout(log_stream):
+            summary = convert_directory(os.path.abspath(args.source), os.path.abspath(args.output), args.mode, style_options,
+                                        jobs=max(1, args.jobs), merge_pdf=args.merge, zip_path=os.path.abspath(args.zip) if args.zip else None, on_progress=on_progress)
+        summary['status'] = 'partial' if summary['failed'] else 'success'
+        exit_code = 1 if summary['failed'] else 0
+    except Exception as e:
+        traceback.print_exc()
+        summary = {'status': 'failure', 'error': str(e), 'source_dir': args.source, 'output_dir': args.output}
+        exit_code = 1
+
+    if args.json:
+        text = json.dumps(summary, ensure_ascii=False, indent=2)
+        if args.json == '-': print(text)
+        else:
+            with open(args.json, 'w', encoding='utf-8') as f: f.write(text + '\n')
+    if summary['status'] != 'failure':
+        print(f"转换完成: {summary['files']} 个文件，{summary['pages']} 页，耗时 {summary['seconds']}s，命中渲染缓存 {summary['cache_hits']} 个", file=sys.stderr)
+        for d in summary['results']:
+            if d['error']: print(f"转换失败: {d['path']}: {d['error']}", file=sys.stderr)
+    else:
+        print(f"转换失败: {summary['error']}", file=sys.stderr)
+    return exit_code
+
 def check_dependencies():
     """检查Pandoc等外部依赖是否存在"""
     print("="*20 + " 正在进行启动环境自检 " + "="*20)
@@ -899,6 +3034,8 @@ def check_dependencies():
         import pypandoc
         pypandoc.get_pandoc_version()
         print("[自检 ✔] Pandoc 已找到。")
+        start_warmup()
+        start_recovery()
         return True
     except OSError:
         print("[自检 ❌] 错误：未在您的系统中找到Pandoc！")
@@ -911,6 +3048,8 @@ def check_dependencies():
         return False
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'convert':
+        sys.exit(cli_convert(sys.argv[2:]))
     if check_dependencies():
         print("="*60)
         print("【v13 个性化增强版】一体化文件转换器 已启动")
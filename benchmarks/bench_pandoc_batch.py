@@ -0,0 +1,43 @@
+"""对比逐个调用Pandoc与批量调用Pandoc时每个文件的平均耗时
+
+用法: python benchmarks/bench_pandoc_batch.py [文件数] [批次大小]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pypandoc
+from app import pandoc_batch_to_html
+
+
+def make_documents(count):
+    return [f"# 文档 {i}\n\n这是第 {i} 篇测试文档，包含 **粗体**、*斜体* 和 [链接](https://example.com)。\n\n"
+            f"- 列表项 A\n- 列表项 B\n\n```python\nprint({i})\n```\n\n| 列1 | 列2 |\n|---|---|\n| {i} | {i * 2} |\n"
+            for i in range(count)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    documents = make_documents(count)
+    print(f"Pandoc {pypandoc.get_pandoc_version()}，文档数: {count}，批次大小: {batch_size}")
+
+    start = time.perf_counter()
+    single = [pypandoc.convert_text(source=text, to='html', format='markdown+latex_macros') for text in documents]
+    single_elapsed = time.perf_counter() - start
+    print(f"逐个调用: 总计 {single_elapsed:.2f}s，平均每个文件 {single_elapsed / count * 1000:.1f}ms")
+
+    start = time.perf_counter()
+    batched = []
+    for offset in range(0, count, batch_size):
+        batched.extend(pandoc_batch_to_html(documents[offset:offset + batch_size], 'kate'))
+    batch_elapsed = time.perf_counter() - start
+    print(f"批量调用: 总计 {batch_elapsed:.2f}s，平均每个文件 {batch_elapsed / count * 1000:.1f}ms")
+
+    mismatched = sum(1 for a, b in zip(single, batched) if a.strip() != b.strip())
+    print(f"输出不一致的文件数: {mismatched}，加速比: {single_elapsed / batch_elapsed:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""对比WeasyPrint首次渲染与复用样式表/字体配置后的渲染耗时
+
+用法: python benchmarks/bench_render_warm.py [渲染次数]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import weasyprint
+from weasyprint.text.fonts import FontConfiguration
+from app import get_css_style, get_font_config, get_stylesheet, make_weasyprint_html
+
+HTML_BODY = "<h1>标题 Title</h1>" + "<p>这是一段用于测试排版速度的中文和 English 混合文本，包含<strong>粗体</strong>和<code>代码</code>。</p>" * 40
+
+
+def render_cold(css_text, root_dir):
+    """每次渲染都重新创建字体配置并解析CSS（改动前的行为）"""
+    font_config = FontConfiguration()
+    css = weasyprint.CSS(string=css_text, font_config=font_config)
+    return make_weasyprint_html(HTML_BODY, root_dir, root_dir).write_pdf(stylesheets=[css], font_config=font_config)
+
+
+def render_warm(css_text, root_dir):
+    return make_weasyprint_html(HTML_BODY, root_dir, root_dir).write_pdf(stylesheets=[get_stylesheet(css_text)], font_config=get_font_config())
+
+
+def timed(func, count, *args):
+    start = time.perf_counter()
+    for _ in range(count): func(*args)
+    return (time.perf_counter() - start) / count * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    css_text = get_css_style({})
+    root_dir = tempfile.mkdtemp()
+    print(f"WeasyPrint {weasyprint.__version__}，渲染次数: {count}")
+    print(f"首次渲染（含字体发现和CSS解析）: {timed(render_warm, 1, css_text, root_dir):.1f}ms")
+    print(f"每次新建字体配置和样式表: 平均 {timed(render_cold, count, css_text, root_dir):.1f}ms")
+    print(f"复用字体配置和样式表: 平均 {timed(render_warm, count, css_text, root_dir):.1f}ms")
+
+
+if __name__ == '__main__':
+    main()